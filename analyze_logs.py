@@ -0,0 +1,319 @@
+"""
+Summarizes controller logs and zigbee2mqtt captures, per knob and per stage.
+
+Reads any mix of controller logs (asctime - LEVEL - message, as smart_knob_log.txt) and
+"topic payload" captures (as messages.txt), plain or gzipped. Files are streamed in
+CHUNK_SIZE reads and every statistic has a fixed size, so memory stays constant however
+large the logs are. Pass rotated logs oldest first:
+
+    python analyze_logs.py smart_knob_mqtt.log.1 smart_knob_mqtt.log
+    python analyze_logs.py messages.txt --json
+
+Per knob it reports the event count and rate, the action mix, linkquality and battery
+(range, mean and trend per hour) and the distribution of gaps between events. Captures
+carry no timestamps, so they only contribute counts, actions and readings.
+
+Stage latencies are measured between log timestamps, so they need a log written at
+DEBUG (dispatch) or INFO (worker, publish) level and have millisecond resolution:
+
+    dispatch  message received -> parser handler called ("Handling ... action")
+    worker    message received -> "Worker thread reported state" for the knob
+    publish   message received -> "Publishing message" on one of the knob's dimmers
+"""
+import argparse
+import gzip
+import json
+import re
+import time
+from collections import Counter
+from datetime import datetime
+
+from knob_metrics import LatencyHistogram, QUANTILES
+
+try:
+    import orjson
+except ImportError:  # Optional faster JSON backend
+    orjson = None
+
+CHUNK_SIZE = 1 << 20  # Bytes read at a time
+DEVICE_MAP_PATH = 'knob_map.json'
+Z2M_BASE_TOPIC = "zigbee2mqtt"
+TOP_ACTIONS = 5  # Actions listed per knob in the text report
+SECONDS_PER_HOUR = 3600.0
+
+LOG_LINE = re.compile(rb"^(\d{4}-\d\d-\d\d) (\d\d):(\d\d):(\d\d),(\d{3}) - (\w+) - (.*)$")
+RECEIVED = b"Received message on topic: "
+PUBLISHING = b"Publishing message: "
+WORKER = b"Worker thread reported state for "
+HANDLING = b"Handling "
+
+json_loads = orjson.loads if orjson is not None else json.loads
+
+def read_lines(path, chunk_size=CHUNK_SIZE):
+    """Yields the lines of a plain or gzipped file as bytes, reading chunk_size bytes at a time."""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as file:
+        rest = b""
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            lines = (rest + chunk).split(b"\n")
+            rest = lines.pop()
+            yield from lines
+        if rest:
+            yield rest
+
+class Trend:
+    """Running range, mean and least-squares slope of a reading over time, in constant memory."""
+
+    __slots__ = ("n", "first", "last", "min", "max", "_sum", "_timed", "_st", "_sx", "_stt", "_stx")
+
+    def __init__(self):
+        self.n = 0
+        self.first = self.last = self.min = self.max = None
+        self._sum = 0.0
+        self._timed = 0
+        self._st = self._sx = self._stt = self._stx = 0.0
+
+    def add(self, value, t=None):
+        """Adds one reading, taken at t seconds if known."""
+        if self.n == 0:
+            self.first = self.min = self.max = value
+        else:
+            self.min = min(self.min, value)
+            self.max = max(self.max, value)
+        self.last = value
+        self.n += 1
+        self._sum += value
+        if t is not None:
+            self._timed += 1
+            self._st += t
+            self._sx += value
+            self._stt += t * t
+            self._stx += t * value
+
+    @property
+    def mean(self):
+        return self._sum / self.n if self.n else None
+
+    def slope_per_hour(self):
+        """Returns the change per hour of the fitted line, or None without two timed readings."""
+        n = self._timed
+        denominator = n * self._stt - self._st * self._st
+        if n < 2 or denominator <= 0:
+            return None
+        return (n * self._stx - self._st * self._sx) / denominator * SECONDS_PER_HOUR
+
+    def summary(self):
+        if not self.n:
+            return None
+        return {"first": self.first, "last": self.last, "min": self.min, "max": self.max,
+                "mean": round(self.mean, 1), "per_hour": self.slope_per_hour()}
+
+class DeviceStats:
+    """Counters for the messages of one knob."""
+
+    __slots__ = ("events", "first_at", "last_at", "actions", "linkquality", "battery", "gaps")
+
+    def __init__(self):
+        self.events = 0
+        self.first_at = None
+        self.last_at = None
+        self.actions = Counter()
+        self.linkquality = Trend()
+        self.battery = Trend()
+        self.gaps = LatencyHistogram()
+
+    def add(self, data, t=None):
+        """Counts one decoded knob message received at t seconds, if known."""
+        self.events += 1
+        if t is not None:
+            if self.last_at is not None:
+                self.gaps.record(int((t - self.last_at) * 1e9))
+            else:
+                self.first_at = t
+            self.last_at = t
+        action = data.get("action")
+        self.actions[action if isinstance(action, str) else "other"] += 1
+        for name, trend in (("linkquality", self.linkquality), ("battery", self.battery)):
+            value = data.get(name)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                trend.add(value, t)
+
+    def summary(self):
+        span = self.last_at - self.first_at if self.first_at is not None else None
+        return {
+            "events": self.events,
+            "span_seconds": span,
+            "events_per_minute": self.events / span * 60 if span else None,
+            "actions": dict(self.actions.most_common()),
+            "linkquality": self.linkquality.summary(),
+            "battery": self.battery.summary(),
+            "gap_seconds": {f"p{q * 100:g}": round(self.gaps.percentile(q) / 1e9, 3) for q in QUANTILES}
+                           if self.gaps.count else None,
+        }
+
+class LogAnalyzer:
+    """
+    Streams log and capture lines into per-knob statistics and stage latency histograms.
+
+    Only the latest receive time of each knob is kept to time the stages, so memory grows
+    with the number of knobs, never with the length of the logs.
+    """
+
+    def __init__(self, device_map=(), base_topic=Z2M_BASE_TOPIC):
+        """
+        Initializes the LogAnalyzer.
+
+        :param device_map: Knob -> dimmer mapping entries, used to match publishes to knobs.
+        :param base_topic: The zigbee2mqtt base topic; its bridge/ topics are not knobs.
+        """
+        self.prefix = base_topic + "/"
+        self.bridge = self.prefix + "bridge/"
+        self.devices = {}
+        self.stages = {stage: LatencyHistogram() for stage in ("dispatch", "worker", "publish")}
+        self.levels = Counter()
+        self.lines = 0
+        self.skipped = 0
+        self._knobs = {}  # dimmer RPC topic -> knobs driving it
+        for entry in device_map:
+            members = entry.get("dimmers") or [entry["dimmer"]]
+            for member in members:
+                dimmer = member if isinstance(member, str) else member["dimmer"]
+                self._knobs.setdefault(f"{dimmer}/rpc", []).append(entry["knob"])
+        self._received_at = {}  # knob -> time of its latest message
+        self._unhandled_at = None  # Time of the latest message not yet matched to a "Handling" line
+        self._midnight = {}  # date bytes -> epoch seconds of its midnight
+
+    def feed(self, path):
+        """Reads one log or capture file."""
+        for line in read_lines(path):
+            self.lines += 1
+            match = LOG_LINE.match(line)
+            if match is not None:
+                self._log_line(match)
+            elif line.strip():
+                topic, _, payload = line.partition(b" ")
+                self._message(topic.decode("utf-8", "replace"), payload, None)
+
+    def _timestamp(self, match):
+        date = match.group(1)
+        midnight = self._midnight.get(date)
+        if midnight is None:
+            midnight = self._midnight[date] = time.mktime(datetime.strptime(date.decode(), "%Y-%m-%d").timetuple())
+        return (midnight + int(match.group(2)) * 3600 + int(match.group(3)) * 60 + int(match.group(4))
+                + int(match.group(5)) / 1000)
+
+    def _log_line(self, match):
+        self.levels[match.group(6).decode()] += 1
+        message = match.group(7)
+        if message.startswith(RECEIVED):
+            topic, _, payload = message[len(RECEIVED):].partition(b" with payload: ")
+            t = self._timestamp(match)
+            self._unhandled_at = t
+            self._message(topic.decode("utf-8", "replace"), payload, t)
+        elif message.startswith(HANDLING):
+            if self._unhandled_at is not None:
+                self._stage("dispatch", self._unhandled_at, self._timestamp(match))
+                self._unhandled_at = None
+        elif message.startswith(WORKER):
+            knob = message[len(WORKER):].partition(b":")[0].decode("utf-8", "replace")
+            self._stage("worker", self._received_at.get(knob), self._timestamp(match))
+        elif message.startswith(PUBLISHING):
+            topic = message[len(PUBLISHING):].partition(b" ")[0].decode("utf-8", "replace")
+            received = [self._received_at[knob] for knob in self._knobs.get(topic, ()) if knob in self._received_at]
+            if received:
+                self._stage("publish", max(received), self._timestamp(match))
+
+    def _stage(self, stage, since, t):
+        if since is not None:
+            self.stages[stage].record(int((t - since) * 1e9))
+
+    def _message(self, topic, payload, t):
+        if not topic.startswith(self.prefix) or topic.startswith(self.bridge):
+            return
+        try:
+            data = json_loads(payload)
+        except ValueError:
+            self.skipped += 1
+            return
+        if not isinstance(data, dict):
+            self.skipped += 1
+            return
+        knob = topic[len(self.prefix):]
+        stats = self.devices.get(knob)
+        if stats is None:
+            stats = self.devices[knob] = DeviceStats()
+        stats.add(data, t)
+        if t is not None:
+            self._received_at[knob] = t
+
+    def summary(self):
+        """Returns every statistic as a JSON-serializable dict."""
+        return {
+            "lines": self.lines,
+            "levels": dict(self.levels),
+            "skipped_payloads": self.skipped,
+            "devices": {knob: stats.summary() for knob, stats in sorted(self.devices.items())},
+            "stages_ms": {stage: dict({f"p{q * 100:g}": round(histogram.percentile(q) / 1e6, 3) for q in QUANTILES},
+                                      count=histogram.count, max=round(histogram.max / 1e6, 3))
+                          for stage, histogram in self.stages.items() if histogram.count},
+        }
+
+def format_trend(trend):
+    if trend is None:
+        return "-"
+    text = f"{trend['min']}..{trend['max']} mean {trend['mean']}"
+    if trend["per_hour"] is not None:
+        text += f" ({trend['per_hour']:+.1f}/h)"
+    return text
+
+def print_report(summary):
+    """Prints the summary as a text report."""
+    levels = ", ".join(f"{level} {count}" for level, count in sorted(summary["levels"].items()))
+    print(f"{summary['lines']} lines ({levels or 'no log lines'}), {summary['skipped_payloads']} undecodable payloads")
+    for knob, stats in summary["devices"].items():
+        rate = f", {stats['events_per_minute']:.2f}/min" if stats["events_per_minute"] else ""
+        print(f"\n{knob}: {stats['events']} events{rate}")
+        actions = list(stats["actions"].items())
+        shown = ", ".join(f"{action} {count}" for action, count in actions[:TOP_ACTIONS])
+        if len(actions) > TOP_ACTIONS:
+            shown += f", {len(actions) - TOP_ACTIONS} more"
+        print(f"  actions:     {shown}")
+        print(f"  linkquality: {format_trend(stats['linkquality'])}")
+        print(f"  battery:     {format_trend(stats['battery'])}")
+        if stats["gap_seconds"]:
+            print("  gaps:        " + "  ".join(f"{q}={seconds:.3f}s" for q, seconds in stats["gap_seconds"].items()))
+    if summary["stages_ms"]:
+        print("\nstage latency from message receipt (ms):")
+        for stage, values in summary["stages_ms"].items():
+            print(f"  {stage:9} " + "  ".join(f"{key}={value:g}" for key, value in values.items()))
+
+def load_device_map(path):
+    """Loads the knob -> dimmer mapping, or no mapping if the file does not exist."""
+    try:
+        with open(path, 'r') as file:
+            return json.load(file)["devices"]
+    except FileNotFoundError:
+        return []
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Summarize controller logs and zigbee2mqtt captures")
+    arg_parser.add_argument("files", nargs="+", help="Logs and captures, oldest first (.gz is read as gzip)")
+    arg_parser.add_argument("--map", default=DEVICE_MAP_PATH, help="Knob -> dimmer mapping, to time publishes")
+    arg_parser.add_argument("--base-topic", default=Z2M_BASE_TOPIC, help="zigbee2mqtt base topic")
+    arg_parser.add_argument("--json", action="store_true", help="Print the summary as JSON")
+    args = arg_parser.parse_args()
+
+    analyzer = LogAnalyzer(load_device_map(args.map), args.base_topic)
+    for path in args.files:
+        analyzer.feed(path)
+    summary = analyzer.summary()
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_report(summary)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Measures the per-message cost of logging on the controller's hot path.
+
+Replays the capture through bench_replay.replay() under three logging setups, with the
+production handler levels (console ERROR, file WARNING) writing to os.devnull:
+
+    off      logging.disable(): the floor with no logging calls doing any work
+    lazy     production setup: root level follows the handlers, debug/info checks cached
+    verbose  the previous setup: root logger at DEBUG, every record created and queued
+
+    python bench_logging.py --repeat 2000
+"""
+import argparse
+import logging
+import os
+
+import smart_knob_mqtt
+from bench_replay import load_capture, repeat_events, replay
+from knob_logging import start_queue_logging, stop_queue_logging
+
+def configure(mode):
+    """Installs the logging setup for a mode and returns the listener to stop afterwards."""
+    logger = logging.getLogger()
+    logger.handlers.clear()
+    logging.disable(logging.NOTSET)
+    if mode == "off":
+        logging.disable(logging.CRITICAL)
+        logger.setLevel(logging.WARNING)
+        smart_knob_mqtt.refresh_log_levels()
+        return None
+    console_handler = logging.StreamHandler(open(os.devnull, 'w'))
+    file_handler = logging.StreamHandler(open(os.devnull, 'w'))
+    console_handler.setLevel(smart_knob_mqtt.CONSOLE_LOG_LEVEL)
+    file_handler.setLevel(smart_knob_mqtt.FILE_LOG_LEVEL)
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    console_handler.setFormatter(formatter)
+    file_handler.setFormatter(formatter)
+    if mode == "verbose":
+        logger.setLevel(logging.DEBUG)
+    else:
+        logger.setLevel(min(smart_knob_mqtt.CONSOLE_LOG_LEVEL, smart_knob_mqtt.FILE_LOG_LEVEL))
+    smart_knob_mqtt.refresh_log_levels()
+    return start_queue_logging(logger, [console_handler, file_handler])
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Per-message logging overhead microbenchmark")
+    arg_parser.add_argument("--capture", default="messages.txt", help="Capture file to replay")
+    arg_parser.add_argument("--repeat", type=int, default=1000, help="Replay the capture this many times")
+    args = arg_parser.parse_args()
+
+    events = repeat_events(load_capture(args.capture), args.repeat)
+    device_map = smart_knob_mqtt.DEFAULT_DEVICE_MAP
+    results = {}
+    for mode in ("off", "lazy", "verbose"):
+        listener = configure(mode)
+        result = replay(events, device_map, speed=None)
+        if listener is not None:
+            stop_queue_logging(listener)
+        results[mode] = result["seconds"] * 1e9 / result["messages"]
+
+    for mode, ns in results.items():
+        print(f"{mode:8} {ns:8.0f} ns/message  overhead {ns - results['off']:+8.0f} ns")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+"""
+Replays captured knob traffic through the controller's hot path and reports throughput.
+
+Sources are the capture format of messages.txt (one "topic payload" per line), the
+controller log format of smart_knob_log.txt, or a synthetic fleet of knobs. Messages
+are dispatched through KnobRouter and the PublishScheduler into a FakeClient that
+answers every Light.Set at once, so no broker is needed.
+
+    python bench_replay.py --log smart_knob_log.txt            # original timing
+    python bench_replay.py --log smart_knob_log.txt --speed 20 # 20x speed-up
+    python bench_replay.py --capture messages.txt --max --repeat 1000
+    python bench_replay.py --synthetic-knobs 2000 --synthetic-events 200000 --max
+    python bench_replay.py --log smart_knob_log.txt --max --compare-acceleration
+    python bench_replay.py --synthetic-knobs 200 --max --compare-dedup
+"""
+import argparse
+import json
+import logging
+import random
+import re
+import time
+from datetime import datetime
+
+from fake_mqtt import FakeClient
+from knob_metrics import LatencyHistogram
+from fade_engine import FADE_MODES
+from publish_scheduler import PublishScheduler, MAX_COMMANDS_PER_SECOND
+from rpc_tracker import RpcTracker
+from smart_knob_mqtt import (AccelerationCurve, KnobRouter, load_device_map, release_due, DEVICE_MAP_PATH,
+                             DEFAULT_ACTION_STEP_SIZE, STEP_SIZE_DIVISOR, Z2M_BASE_TOPIC)
+
+CAPTURE_EVENT_GAP = 0.25  # Seconds between capture lines, which carry no timestamps
+GESTURE_GAP = 1.5  # Seconds without a same-direction step that end a spin gesture
+STEP_ACTIONS = {  # action -> (direction, default step size, divisor), as applied by SmartKnobParser
+    "rotate_right": (1, DEFAULT_ACTION_STEP_SIZE, 1),
+    "rotate_left": (-1, DEFAULT_ACTION_STEP_SIZE, 1),
+    "brightness_step_up": (1, 0, STEP_SIZE_DIVISOR),
+    "brightness_step_down": (-1, 0, STEP_SIZE_DIVISOR),
+}
+LOG_LINE = re.compile(r"^(\S+ \S+) - \w+ - Received message on topic: (\S+) with payload: (.*)$")
+
+class ReplayClock:
+    """Clock handed to the scheduler so replayed time follows the recording, not the wall."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def load_capture(path):
+    """Loads a "topic payload" capture file as a list of (seconds, topic, payload bytes)."""
+    events = []
+    with open(path, 'r') as file:
+        for line in file:
+            topic, _, payload = line.rstrip('\n').partition(' ')
+            if payload:
+                events.append((len(events) * CAPTURE_EVENT_GAP, topic, payload.encode("utf-8")))
+    return events
+
+def load_log(path):
+    """Loads the "Received message" lines of a controller log as (seconds, topic, payload bytes)."""
+    events = []
+    start = None
+    with open(path, 'r') as file:
+        for line in file:
+            match = LOG_LINE.match(line.rstrip('\n'))
+            if not match:
+                continue
+            stamp = datetime.strptime(match.group(1), "%Y-%m-%d %H:%M:%S,%f").timestamp()
+            if start is None:
+                start = stamp
+            events.append((stamp - start, match.group(2), match.group(3).encode("utf-8")))
+    return events
+
+def gesture_payloads(rng):
+    """
+    Generates the messages of one gesture on a knob: a press, or a spin made of a rapid
+    rotate/step burst, using the payload shapes seen in messages.txt.
+
+    :param rng: The random.Random to draw from.
+    :return: List of payload bytes.
+    """
+    linkquality = rng.randint(10, 120)
+    gesture = rng.random()
+    if gesture < 0.2:
+        payloads = [{"action": "single", "operation_mode": "event"}]
+    elif gesture < 0.3:
+        payloads = [{"action": "toggle", "operation_mode": "command"}]
+    elif gesture < 0.65:
+        action = rng.choice(("rotate_left", "rotate_right"))
+        payloads = [{"action": action, "operation_mode": "event"}] * rng.randint(2, 15)
+    else:
+        action = rng.choice(("brightness_step_up", "brightness_step_down"))
+        payloads = [{"action": action, "action_step_size": rng.randint(13, 121),
+                     "action_transition_time": 0.01, "operation_mode": "command"}] * rng.randint(2, 10)
+    return [json.dumps(dict(data, battery=100, linkquality=linkquality, voltage=3000),
+                       separators=(',', ':')).encode("utf-8") for data in payloads]
+
+def synthetic_events(knobs, count, seed=1):
+    """
+    Generates a device map and an event stream for a fleet of knobs.
+
+    Each knob alternates idle gaps and gestures from gesture_payloads().
+
+    :return: (device_map, events) where events are (seconds, topic, payload) in time order.
+    """
+    rng = random.Random(seed)
+    device_map = [{"knob": f"Bench_Knob_{i}", "dimmer": f"bench_dimmer_{i}"} for i in range(knobs)]
+    clocks = [rng.uniform(0, 5) for _ in range(knobs)]
+    events = []
+    while len(events) < count:
+        knob = rng.randrange(knobs)
+        topic = f"{Z2M_BASE_TOPIC}/Bench_Knob_{knob}"
+        t = clocks[knob] + rng.expovariate(1 / 5)
+        for payload in gesture_payloads(rng):
+            events.append((t, topic, payload))
+            t += rng.uniform(0.05, 0.2)
+        clocks[knob] = t
+    events.sort(key=lambda event: event[0])
+    return device_map, events[:count]
+
+def repeat_events(events, times):
+    """Repeats an event stream back to back, shifting each copy past the previous one."""
+    if times <= 1 or not events:
+        return events
+    span = events[-1][0] + CAPTURE_EVENT_GAP
+    return [(t + n * span, topic, payload) for n in range(times) for t, topic, payload in events]
+
+def accelerated_gestures(events, curve):
+    """
+    Rewrites an event stream the way a user would produce it with step acceleration.
+
+    Steps are grouped into gestures: same-direction steps on one knob no more than
+    GESTURE_GAP apart. The user is assumed to stop turning once the light has travelled
+    as far as the whole gesture moved it without acceleration, so each gesture is cut
+    after the step at which the accelerated travel catches up.
+
+    :param events: List of (seconds, topic, payload) in time order.
+    :param curve: The AccelerationCurve to apply.
+    :return: The shortened event list.
+    """
+    gestures = {}  # topic -> (direction, last time, event indexes)
+    finished = []
+    for index, (t, topic, payload) in enumerate(events):
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            continue
+        step = STEP_ACTIONS.get(data.get("action")) if isinstance(data, dict) else None
+        if step is None:
+            continue
+        gesture = gestures.get(topic)
+        if gesture is None or gesture[0] != step[0] or t - gesture[1] > GESTURE_GAP:
+            if gesture is not None:
+                finished.append(gesture[2])
+            gesture = (step[0], t, [])
+        gesture[2].append(index)
+        gestures[topic] = (gesture[0], t, gesture[2])
+    finished.extend(gesture[2] for gesture in gestures.values())
+
+    dropped = set()
+    for indexes in finished:
+        sizes = []
+        for index in indexes:
+            data = json.loads(events[index][2])
+            _, default, divisor = STEP_ACTIONS[data["action"]]
+            sizes.append((data.get("action_step_size", default), divisor))
+        target = sum(int(size / divisor) for size, divisor in sizes)
+        travelled = 0
+        for n, index in enumerate(indexes):
+            if travelled >= target:
+                dropped.update(indexes[n:])
+                break
+            size, divisor = sizes[n]
+            if n:
+                size = round(size * curve.factor(events[index][0] - events[indexes[n - 1]][0]))
+            travelled += int(size / divisor)
+    return [event for index, event in enumerate(events) if index not in dropped]
+
+def replay(events, device_map, speed=1.0, max_rate=MAX_COMMANDS_PER_SECOND, acceleration=None, fade=None,
+           dedup=True):
+    """
+    Replays events through the router, scheduler and publish path.
+
+    :param events: List of (seconds, topic, payload) in time order.
+    :param device_map: Knob -> dimmer mapping entries.
+    :param speed: Wall-clock speed-up factor; 1 is original timing, None replays as fast as possible.
+                  The scheduler always sees the recorded timeline, so publish counts do not depend on it.
+    :param max_rate: Maximum Light.Set commands per second per dimmer.
+    :param acceleration: If given, overrides the "acceleration" entry of every mapping.
+    :param fade: If given, overrides the "fade" mode of every mapping.
+    :param dedup: Drop commands that would not change the acknowledged dimmer state.
+    :return: Dict of results.
+    """
+    if acceleration is not None:
+        device_map = [dict(entry, acceleration=acceleration) for entry in device_map]
+    if fade is not None:
+        device_map = [dict(entry, fade=fade) for entry in device_map]
+    clock = ReplayClock()
+    router = KnobRouter(device_map, clock=clock, rpc_tracker=RpcTracker(clock=clock))
+    if not dedup:
+        router.dedup = None
+    scheduler = PublishScheduler(max_rate, clock=clock)
+    router.configure_scheduler(scheduler)
+    client = FakeClient(userdata=router, record=False, rpc_replies=True)
+    latency = LatencyHistogram()
+
+    def release(now):
+        release_due(router, client, scheduler, now, {})
+
+    wall_start = time.perf_counter()
+    for t, topic, payload in events:
+        deadline = scheduler.next_deadline()
+        while deadline is not None and deadline <= t:
+            clock.now = deadline
+            release(deadline)
+            deadline = scheduler.next_deadline()
+        if speed:
+            delay = wall_start + t / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        clock.now = t
+        started = time.perf_counter_ns()
+        router.dispatch(topic, payload)
+        for route in router.take_dirty(0):
+            for topic, target in route.targets(route.parser.report_state()):
+                scheduler.submit(topic, target, t)
+        release(t)
+        latency.record(time.perf_counter_ns() - started)
+    while scheduler.next_deadline() is not None:
+        clock.now = scheduler.next_deadline()
+        release(clock.now)
+    elapsed = time.perf_counter() - wall_start
+
+    return {
+        "messages": len(events),
+        "seconds": elapsed,
+        "messages_per_second": len(events) / elapsed if elapsed else 0.0,
+        "p50_us": latency.percentile(0.5) / 1e3,
+        "p99_us": latency.percentile(0.99) / 1e3,
+        "max_us": latency.max / 1e3,
+        "publishes": client.publish_count,
+        "scheduler": scheduler.stats(),
+        "dedup": router.dedup.stats() if dedup else None,
+    }
+
+def compare_acceleration(events, device_map, max_rate=MAX_COMMANDS_PER_SECOND, curve=None):
+    """
+    Replays the events as recorded without acceleration, and as accelerated_gestures()
+    shortens them with acceleration, as fast as possible.
+
+    :param curve: The AccelerationCurve, the default curve if None.
+    :return: (plain, accelerated) replay() results.
+    """
+    shortened = accelerated_gestures(events, curve or AccelerationCurve())
+    plain = replay(events, device_map, None, max_rate, acceleration=False)
+    accelerated = replay(shortened, device_map, None, max_rate, acceleration=True)
+    return plain, accelerated
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Replay knob traffic through the controller hot path")
+    source = arg_parser.add_mutually_exclusive_group()
+    source.add_argument("--capture", help="Capture file with one 'topic payload' per line (messages.txt)")
+    source.add_argument("--log", help="Controller log with 'Received message' lines (smart_knob_log.txt)")
+    source.add_argument("--synthetic-knobs", type=int, help="Generate traffic for this many knobs")
+    arg_parser.add_argument("--synthetic-events", type=int, default=100000, help="Number of synthetic events")
+    arg_parser.add_argument("--map", default=DEVICE_MAP_PATH, help="Knob -> dimmer mapping for capture/log replay")
+    arg_parser.add_argument("--speed", type=float, default=1.0, help="Speed-up factor over the recorded timing")
+    arg_parser.add_argument("--max", action="store_true", help="Replay as fast as possible")
+    arg_parser.add_argument("--repeat", type=int, default=1, help="Replay the recording this many times")
+    arg_parser.add_argument("--max-rate", type=float, default=MAX_COMMANDS_PER_SECOND,
+                            help="Maximum Light.Set commands per second per dimmer")
+    arg_parser.add_argument("--fade", choices=FADE_MODES, help="Override the fade mode of every dimmer")
+    arg_parser.add_argument("--compare-acceleration", action="store_true",
+                            help="Replay with and without step acceleration and compare the publishes")
+    arg_parser.add_argument("--compare-dedup", action="store_true",
+                            help="Replay with and without the last-acknowledged dedup cache and compare the publishes")
+    args = arg_parser.parse_args()
+
+    # Keep the replayed error lines (e.g. messages without an action) off the console
+    logging.getLogger().setLevel(logging.CRITICAL)
+    if args.synthetic_knobs:
+        device_map, events = synthetic_events(args.synthetic_knobs, args.synthetic_events)
+    else:
+        events = load_log(args.log) if args.log else load_capture(args.capture or "messages.txt")
+        device_map = load_device_map(args.map)
+    events = repeat_events(events, args.repeat)
+
+    if args.compare_acceleration:
+        plain, accelerated = compare_acceleration(events, device_map, args.max_rate)
+        print(f"without acceleration: {plain['messages']} events  {plain['publishes']} publishes")
+        print(f"with acceleration:    {accelerated['messages']} events  {accelerated['publishes']} publishes "
+              f"({accelerated['publishes'] - plain['publishes']:+d})")
+        return
+
+    if args.compare_dedup:
+        speed = None if args.max else args.speed
+        plain = replay(events, device_map, speed, args.max_rate, fade=args.fade, dedup=False)
+        deduped = replay(events, device_map, speed, args.max_rate, fade=args.fade)
+        print(f"without dedup: {plain['publishes']} publishes")
+        print(f"with dedup:    {deduped['publishes']} publishes ({deduped['publishes'] - plain['publishes']:+d})  "
+              f"{deduped['dedup']}")
+        return
+
+    result = replay(events, device_map, None if args.max else args.speed, args.max_rate, fade=args.fade)
+    print(f"messages: {result['messages']}  seconds: {result['seconds']:.3f}  "
+          f"msg/s: {result['messages_per_second']:.0f}")
+    print(f"handling latency: p50={result['p50_us']:.1f}us  p99={result['p99_us']:.1f}us  "
+          f"max={result['max_us']:.1f}us")
+    print(f"publishes: {result['publishes']}  scheduler: {result['scheduler']}  dedup: {result['dedup']}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Measures the memory per knob and the cost of one worker pass for the two knob state layouts:
+
+    objects  SmartKnobParser per knob, each with its own Condition (the default)
+    arrays   ArrayKnobRouter: one KnobStateArray shared by all knobs (--compact-state)
+
+Memory is counted with tracemalloc, for the whole router and for the knob state alone
+(the parsers, or the parser views plus the arrays). The pass marks a share of the knobs
+dirty and times take_dirty() plus report_state() on each route, as worker_thread does.
+
+    python bench_state_memory.py --knobs 10000 --dirty 0.1
+"""
+import argparse
+import logging
+import time
+import tracemalloc
+
+from compact_state import ArrayKnobParser, ArrayKnobRouter, KnobStateArray
+from smart_knob_mqtt import KnobRouter, SmartKnobParser
+
+def object_parsers(knobs):
+    return [SmartKnobParser() for _ in range(knobs)]
+
+def array_parsers(knobs):
+    states = KnobStateArray()
+    return states, [ArrayKnobParser(states) for _ in range(knobs)]
+
+def build(router_class, knobs):
+    """Builds a router for a fleet of knobs and returns it with the bytes it allocated."""
+    device_map = [{"knob": f"Bench_Knob_{i}", "dimmer": f"bench_dimmer_{i}"} for i in range(knobs)]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    router = router_class(device_map)
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return router, allocated
+
+def state_bytes(parser_factory, knobs):
+    """Returns the bytes allocated for the knob state alone: the parsers, or the views and arrays."""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    parsers = parser_factory(knobs)
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del parsers
+    return allocated
+
+def worker_pass(router, dirty, rounds=20):
+    """Returns the mean seconds of one take_dirty() + report_state() pass with the given share dirty."""
+    routes = list(router.routes.values())
+    stride = max(1, round(1 / dirty)) if dirty else len(routes) + 1
+    total = 0.0
+    for n in range(rounds):
+        for route in routes[n % stride::stride]:
+            route.parser.brightness = 40 + n  # A new value every round, so no knob is skipped as unchanged
+        started = time.perf_counter()
+        for route in router.take_dirty(0):
+            route.parser.report_state()
+        total += time.perf_counter() - started
+    return total / rounds
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Compare the memory and worker pass of the knob state layouts")
+    arg_parser.add_argument("--knobs", type=int, default=10000, help="Number of knobs")
+    arg_parser.add_argument("--dirty", type=float, default=0.1, help="Share of knobs dirty in each pass")
+    args = arg_parser.parse_args()
+
+    logging.getLogger().setLevel(logging.CRITICAL)
+    for name, router_class, parser_factory in (("objects", KnobRouter, object_parsers),
+                                               ("arrays", ArrayKnobRouter, array_parsers)):
+        router, allocated = build(router_class, args.knobs)
+        state = state_bytes(parser_factory, args.knobs)
+        seconds = worker_pass(router, args.dirty)
+        print(f"{name:8} router: {allocated / args.knobs:7.0f} B/knob  state: {state / args.knobs:6.0f} B/knob  "
+              f"pass: {seconds * 1e3:7.2f} ms ({int(args.knobs * args.dirty)} dirty)")
+
+if __name__ == "__main__":
+    main()
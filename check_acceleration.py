@@ -0,0 +1,42 @@
+"""
+Checks that step acceleration cuts the publishes of recorded and synthetic knob traffic.
+
+Replays each source through bench_replay.compare_acceleration() and exits with status 1
+if the accelerated replay does not save at least the expected share of publishes, so a
+change that undoes the saving fails instead of only printing different numbers.
+
+    python check_acceleration.py
+"""
+import logging
+import sys
+
+from bench_replay import compare_acceleration, load_log, synthetic_events
+from smart_knob_mqtt import load_device_map
+
+MIN_LOG_SAVING = 0.05  # Share of publishes acceleration must save on smart_knob_log.txt (21 -> 19 when written)
+MIN_SYNTHETIC_SAVING = 0.2  # Same for the synthetic fleet (1809 -> 1212 when written)
+
+def check(name, plain, accelerated, min_saving):
+    """
+    Compares one pair of replays.
+
+    :return: True if the accelerated replay saved at least min_saving of the publishes.
+    """
+    saving = 1 - accelerated["publishes"] / plain["publishes"]
+    passed = saving >= min_saving
+    print(f"{'ok' if passed else 'FAIL':4}  {name}: {plain['publishes']} -> {accelerated['publishes']} publishes "
+          f"({saving:.0%} saved, at least {min_saving:.0%} expected)")
+    return passed
+
+def main():
+    # Keep the replayed error lines (e.g. messages without an action) off the console
+    logging.getLogger().setLevel(logging.CRITICAL)
+    results = [check("smart_knob_log.txt", *compare_acceleration(load_log("smart_knob_log.txt"), load_device_map()),
+                     MIN_LOG_SAVING)]
+    device_map, events = synthetic_events(50, 5000)
+    results.append(check("synthetic, 50 knobs", *compare_acceleration(events, device_map), MIN_SYNTHETIC_SAVING))
+    if not all(results):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+"""
+Struct-of-arrays knob state for installations with thousands of knobs.
+
+The default SmartKnobParser keeps every knob's state in its own object with a
+threading.Condition. Here the state lives in typed arrays indexed by a slot number
+instead, and dirty knobs are flags in one bitmap that the worker scans in bulk:
+
+    python smart_knob_mqtt.py --compact-state
+"""
+import re
+import time
+from array import array
+
+from smart_knob_mqtt import KnobRouter, SmartKnobParser
+
+NEVER_SENT = -1  # sent_brightness/sent_output of a slot whose state was never handed to the publisher
+_NONZERO = re.compile(rb"[^\x00]")  # Bitmap bytes with at least one dirty slot, found by a C-level scan
+
+class KnobStateArray:
+    """
+    Knob state for any number of knobs, kept in typed arrays indexed by slot.
+
+    Per slot it holds the brightness and output, the last state handed to the publisher,
+    the time of the last knob-driven change, the acceleration state, and one bit in the
+    dirty bitmap: 22 bytes per knob.
+
+    Slots given back with release() are reused by later allocate() calls, so routes
+    rebuilt by a config reload do not grow the arrays.
+
+    The arrays are not locked. Writers of a single element need no lock; the dirty bitmap
+    is read-modify-write, so mark_dirty(), release() and take_dirty() must be serialized
+    by the caller, as ArrayKnobRouter does under its Condition.
+    """
+
+    def __init__(self):
+        self.brightness = array('B')
+        self.output = array('B')
+        self.sent_brightness = array('h')
+        self.sent_output = array('b')
+        self.changed_at = array('d')  # time.monotonic() of the last change, 0.0 if none
+        self.step_direction = array('b')  # Direction of the last acceleration step
+        self.step_at = array('d')  # Time of the last acceleration step
+        self.dirty = bytearray()  # One bit per slot
+        self.any_dirty = False
+        self._free = []  # Released slots, reused before the arrays grow
+
+    def __len__(self):
+        return len(self.brightness)
+
+    def allocate(self):
+        """Returns a slot, reused or added, holding the state of a new SmartKnobParser."""
+        if self._free:
+            slot = self._free.pop()
+            self.brightness[slot] = 0
+            self.output[slot] = 0
+            self.sent_brightness[slot] = NEVER_SENT
+            self.sent_output[slot] = NEVER_SENT
+            self.changed_at[slot] = 0.0
+            self.step_direction[slot] = 0
+            self.step_at[slot] = 0.0
+            return slot
+        slot = len(self.brightness)
+        self.brightness.append(0)
+        self.output.append(0)
+        self.sent_brightness.append(NEVER_SENT)
+        self.sent_output.append(NEVER_SENT)
+        self.changed_at.append(0.0)
+        self.step_direction.append(0)
+        self.step_at.append(0.0)
+        if slot % 8 == 0:
+            self.dirty.append(0)
+        return slot
+
+    def release(self, slot):
+        """Gives a slot back for reuse and clears its dirty bit."""
+        self.dirty[slot >> 3] &= ~(1 << (slot & 7)) & 0xff
+        self._free.append(slot)
+
+    def mark_dirty(self, slot, now):
+        """Sets the dirty bit of a slot and records the time of the change."""
+        self.dirty[slot >> 3] |= 1 << (slot & 7)
+        self.changed_at[slot] = now
+        self.any_dirty = True
+
+    def take_dirty(self):
+        """
+        Returns the dirty slots whose state differs from the last one handed out, in slot order.
+
+        Scans the bitmap for non-zero bytes in one pass and clears them. Slots that went
+        back to their last sent state, e.g. toggled twice between two passes, are dropped.
+
+        :return: List of slot indexes.
+        """
+        slots = []
+        if not self.any_dirty:
+            return slots
+        bitmap = self.dirty
+        brightness, output = self.brightness, self.output
+        sent_brightness, sent_output = self.sent_brightness, self.sent_output
+        for match in _NONZERO.finditer(bitmap):
+            index = match.start()
+            bits = bitmap[index]
+            bitmap[index] = 0
+            base = index << 3
+            while bits:
+                low = bits & -bits
+                slot = base + low.bit_length() - 1
+                bits ^= low
+                if brightness[slot] != sent_brightness[slot] or output[slot] != sent_output[slot]:
+                    slots.append(slot)
+        self.any_dirty = False
+        return slots
+
+    def record_sent(self, slot):
+        """Records the current state of a slot as handed to the publisher and returns it as a dict."""
+        brightness = self.brightness[slot]
+        output = self.output[slot]
+        self.sent_brightness[slot] = brightness
+        self.sent_output[slot] = output
+        return {"brightness": brightness, "output": bool(output)}
+
+    def nbytes(self):
+        """Returns the bytes used by the array buffers."""
+        return sum(data.itemsize * len(data) for data in (
+            self.brightness, self.output, self.sent_brightness, self.sent_output, self.changed_at,
+            self.step_direction, self.step_at)) + len(self.dirty)
+
+class ArrayKnobParser:
+    """
+    A view on one slot of a KnobStateArray that handles knob messages like SmartKnobParser.
+
+    The action handlers and message decoding are SmartKnobParser's own, so both parsers
+    behave the same; only where the state is kept differs. The view holds no state of its
+    own beyond its slot.
+    """
+
+    __slots__ = ("_states", "slot", "_on_dirty", "_acceleration", "_clock")
+
+    def __init__(self, states, on_dirty=None, acceleration=None, clock=time.monotonic):
+        """
+        Initializes the ArrayKnobParser on a newly allocated slot.
+
+        :param states: The KnobStateArray holding the state.
+        :param on_dirty: Optional callable invoked with the parser whenever its state changes.
+        :param acceleration: Optional AccelerationCurve applied to rotation and brightness steps.
+        :param clock: Monotonic clock returning seconds, used to time the steps.
+        """
+        self._states = states
+        self.slot = states.allocate()
+        self._on_dirty = on_dirty
+        self._acceleration = acceleration
+        self._clock = clock
+
+    @property
+    def brightness(self):
+        """Gets the current brightness value."""
+        return self._states.brightness[self.slot]
+
+    @brightness.setter
+    def brightness(self, value):
+        """Sets the brightness value and marks the state as dirty."""
+        self._states.brightness[self.slot] = value
+        if self._on_dirty is not None:
+            self._on_dirty(self)
+
+    _brightness = brightness  # Read by SmartKnobParser.set_brightness()
+
+    @property
+    def output(self):
+        """Gets the current output state."""
+        return bool(self._states.output[self.slot])
+
+    @output.setter
+    def output(self, value):
+        """Sets the output state and marks the state as dirty."""
+        self._states.output[self.slot] = bool(value)
+        if self._on_dirty is not None:
+            self._on_dirty(self)
+
+    @property
+    def dirty(self):
+        """Gets the dirty state."""
+        return bool(self._states.dirty[self.slot >> 3] & (1 << (self.slot & 7)))
+
+    @property
+    def _last_step_direction(self):
+        return self._states.step_direction[self.slot]
+
+    @_last_step_direction.setter
+    def _last_step_direction(self, value):
+        self._states.step_direction[self.slot] = value
+
+    @property
+    def _last_step_at(self):
+        return self._states.step_at[self.slot]
+
+    @_last_step_at.setter
+    def _last_step_at(self, value):
+        self._states.step_at[self.slot] = value
+
+    def restore_state(self, brightness, output):
+        """Sets the brightness and output without marking the state dirty, e.g. after a restart."""
+        states = self._states
+        states.brightness[self.slot] = brightness
+        states.output[self.slot] = bool(output)
+        # The restored state is the one the dimmer has, so there is nothing to send
+        states.record_sent(self.slot)
+
+    def report_state(self):
+        """Reports the current brightness and output state and records it as sent."""
+        return self._states.record_sent(self.slot)
+
+    actions = SmartKnobParser.actions
+    parse_message = SmartKnobParser.parse_message
+    decode_payload = staticmethod(SmartKnobParser.decode_payload)
+    find_handler = SmartKnobParser.find_handler
+    handle_data = SmartKnobParser.handle_data
+    accelerate = SmartKnobParser.accelerate
+    set_brightness = SmartKnobParser.set_brightness
+
+class ArrayKnobRouter(KnobRouter):
+    """
+    KnobRouter whose knobs share one KnobStateArray.
+
+    Dirty knobs are bits in the array's bitmap instead of entries in a queue, and
+    take_dirty() collects all of them in one scan.
+    """
+
+    def __init__(self, device_map, metrics=None, state_store=None, device_states=None, clock=time.monotonic,
+                 rpc_tracker=None):
+        self.states = KnobStateArray()
+        self._slots = []  # slot -> route
+        super().__init__(device_map, parser_factory=self._new_parser, metrics=metrics, state_store=state_store,
+                         device_states=device_states, clock=clock, rpc_tracker=rpc_tracker)
+
+    def _new_parser(self, **kwargs):
+        parser = ArrayKnobParser(self.states, **kwargs)
+        if parser.slot == len(self._slots):
+            self._slots.append(None)
+        return parser
+
+    def _install_route(self, route):
+        super()._install_route(route)
+        self._slots[route.parser.slot] = route
+
+    def _remove_route(self, knob_topic):
+        route = super()._remove_route(knob_topic)
+        with self._cond:
+            self._slots[route.parser.slot] = None
+            self.states.release(route.parser.slot)
+        return route
+
+    def _changed_at(self, route):
+        return self.states.changed_at[route.parser.slot] or None
+
+    def _mark_dirty(self, route):
+        """Sets the route's dirty bit and wakes the worker thread."""
+        if self.metrics is not None:
+            self.metrics.observe("state_change", route.event_ns)
+        with self._cond:
+            self.states.mark_dirty(route.parser.slot, time.monotonic())
+            self._cond.notify()
+
+    def take_dirty(self, timeout=None):
+        """
+        Waits for dirty routes and returns them, clearing the bitmap.
+
+        :param timeout: Maximum time in seconds to wait, or None to wait indefinitely.
+        :return: List of routes whose state changed since it was last reported, in slot order.
+        """
+        with self._cond:
+            if not self.states.any_dirty:
+                self._cond.wait(timeout)
+            slots = self.states.take_dirty()
+            routes = [self._slots[slot] for slot in slots]
+        return [route for route in routes if route is not None]
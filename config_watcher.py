@@ -0,0 +1,76 @@
+import logging
+import os
+import time
+
+CONFIG_POLL_INTERVAL = 2.0  # Seconds between checks of the config file
+
+class ConfigWatcher:
+    """
+    Detects changes to a config file and loads the new version.
+
+    The file is checked with os.stat() every CONFIG_POLL_INTERVAL seconds. A change of
+    inode, size or modification time means it was rewritten, including by editors and
+    tools that replace it through a rename. A version that fails to load is reported and
+    skipped, and the current config stays in effect until the file changes again, so a
+    half-written or mistyped file never reaches the controller. A file that disappears
+    also leaves the current config in place.
+
+    Like PublishScheduler, the watcher runs no thread of its own: the caller calls poll()
+    from the thread that should apply the changes.
+    """
+
+    def __init__(self, path, load, interval=CONFIG_POLL_INTERVAL, clock=time.monotonic):
+        """
+        Initializes the ConfigWatcher and loads the current config.
+
+        :param path: The config file.
+        :param load: Callable taking the path and returning the parsed config; it raises
+                     ValueError, KeyError or TypeError on an invalid file.
+        :param interval: Seconds between checks.
+        :param clock: Monotonic clock returning seconds.
+        """
+        self.path = path
+        self._load = load
+        self.interval = interval
+        self._clock = clock
+        self._signature = self._stat()
+        self.config = load(path)
+        self._next_check = clock() + interval
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def next_deadline(self):
+        """Returns the time of the next check."""
+        return self._next_check
+
+    def poll(self, now=None):
+        """
+        Checks the file if a check is due and loads it if it changed.
+
+        :param now: Current time in seconds, defaults to the watcher clock.
+        :return: The new config, or None if the file did not change or is invalid.
+        """
+        if now is None:
+            now = self._clock()
+        if now < self._next_check:
+            return None
+        self._next_check = now + self.interval
+        signature = self._stat()
+        if signature == self._signature:
+            return None
+        self._signature = signature
+        if signature is None:
+            logging.warning(f"Config {self.path} disappeared, keeping the current config")
+            return None
+        try:
+            config = self._load(self.path)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.error(f"Invalid config {self.path}, keeping the current config: {e!r}")
+            return None
+        self.config = config
+        return config
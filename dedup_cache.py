@@ -0,0 +1,85 @@
+import threading
+
+class DedupCache:
+    """
+    Last state each dimmer acknowledged, used to drop Light.Set commands that change nothing.
+
+    A command is compared with the state the dimmer last confirmed through its RPC
+    response. If neither output nor brightness differs it is suppressed; if only one
+    differs, only that field is sent. While a command to the dimmer is still waiting
+    for its response the dimmer's state is not known, so commands go out in full.
+
+    Dimmer status events never become a basis for suppression, since they also report
+    the steps of a running transition. An event that disagrees with the cached state
+    only drops it, e.g. after the light was changed from the Shelly app.
+
+    sent() is called from the publisher and acknowledge() from the MQTT network thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._confirmed = {}  # key -> (brightness, output) the dimmer acknowledged
+        self._unconfirmed = {}  # key -> (request id, brightness, output) of the newest command sent
+        self.suppressed = 0
+        self.trimmed = 0
+
+    def changes(self, key, command):
+        """
+        Returns the part of a command that changes the dimmer's state.
+
+        :param key: The device (the RPC topic).
+        :param command: The state to publish, from FadeEngine.plan().
+        :return: The command, the command without its unchanged field, or None if it changes nothing.
+        """
+        with self._lock:
+            if key in self._unconfirmed:
+                return command
+            confirmed = self._confirmed.get(key)
+        if confirmed is None:
+            return command
+        brightness_changed = command["brightness"] != confirmed[0]
+        output_changed = command["output"] != confirmed[1]
+        if brightness_changed and output_changed:
+            return command
+        if brightness_changed:
+            self.trimmed += 1
+            return {name: value for name, value in command.items() if name != "output"}
+        if output_changed:
+            self.trimmed += 1
+            return {"output": command["output"]}
+        self.suppressed += 1
+        return None
+
+    def sent(self, key, request_id, command):
+        """Records a command about to be published, in full, until its response arrives."""
+        with self._lock:
+            self._unconfirmed[key] = (request_id, command["brightness"], command["output"])
+
+    def acknowledge(self, key, request_id, ok=True):
+        """
+        Records the response to a command.
+
+        :param key: The device (the RPC topic).
+        :param request_id: The id of the response.
+        :param ok: False if the dimmer answered with an error.
+        :return: None
+        """
+        with self._lock:
+            entry = self._unconfirmed.get(key)
+            if entry is None or entry[0] != request_id:
+                return  # An older command; the newest one is still unanswered
+            del self._unconfirmed[key]
+            if ok:
+                self._confirmed[key] = entry[1:]
+            else:
+                self._confirmed.pop(key, None)
+
+    def observe(self, key, brightness, output):
+        """Drops the cached state of a dimmer whose reported status disagrees with it."""
+        with self._lock:
+            if self._confirmed.get(key, (brightness, output)) != (brightness, output):
+                del self._confirmed[key]
+
+    def stats(self):
+        """Returns the suppressed and trimmed command counters."""
+        return {"suppressed": self.suppressed, "trimmed": self.trimmed}
@@ -0,0 +1,107 @@
+import json
+import logging
+import threading
+
+from rpc_tracker import next_request_id
+
+LIGHT_COMPONENT = "light:0"  # Status key of the dimmer channel in NotifyStatus events
+STATUS_METHODS = ("NotifyStatus", "NotifyFullStatus")
+MAX_PENDING_REQUESTS = 1024  # Bound on Light.GetStatus requests waiting for a reply
+
+class DeviceStateCache:
+    """
+    Last known light state of each Shelly dimmer.
+
+    The cache is seeded with one Light.GetStatus request per dimmer over MQTT RPC. Replies
+    arrive on <src>/rpc and are matched to their dimmer by request id. From then on it is
+    kept current by the NotifyStatus events every dimmer publishes on <dimmer>/events/rpc
+    when its output or brightness changes, so the devices never have to be polled.
+
+    NotifyStatus only carries the fields that changed, so updates are merged into the
+    cached state.
+    """
+
+    def __init__(self, src):
+        """
+        Initializes the DeviceStateCache.
+
+        :param src: The RPC source name; Shelly devices publish replies to <src>/rpc.
+        """
+        self.src = src
+        self.reply_topic = f"{src}/rpc"
+        self._lock = threading.Lock()
+        self._state = {}  # dimmer -> {"brightness": ..., "output": ...}
+        self._requests = {}  # request id -> dimmer
+
+    def subscriptions(self, dimmers):
+        """Returns the topics carrying status events of the given dimmers and the RPC replies."""
+        return [self.reply_topic] + [f"{dimmer}/events/rpc" for dimmer in sorted(set(dimmers))]
+
+    def is_status_topic(self, topic):
+        """Returns True if messages on the topic may carry dimmer state."""
+        return topic == self.reply_topic or topic.endswith("/events/rpc")
+
+    def status_request(self, dimmer):
+        """
+        Builds a Light.GetStatus request for a dimmer.
+
+        :param dimmer: The Shelly device id.
+        :return: (topic, payload) to publish.
+        """
+        request_id = next_request_id()
+        with self._lock:
+            self._requests[request_id] = dimmer
+            if len(self._requests) > MAX_PENDING_REQUESTS:
+                del self._requests[next(iter(self._requests))]
+        payload = json.dumps({"id": request_id, "src": self.src, "method": "Light.GetStatus",
+                              "params": {"id": 0}}, separators=(',', ':'))
+        return f"{dimmer}/rpc", payload
+
+    def handle(self, topic, data):
+        """
+        Updates the cache from a decoded RPC reply or status event.
+
+        :param topic: The MQTT topic the message arrived on.
+        :param data: The decoded payload.
+        :return: The dimmer whose state changed, or None.
+        """
+        if not isinstance(data, dict):
+            return None
+        if topic == self.reply_topic:
+            with self._lock:
+                try:
+                    dimmer = self._requests.pop(data.get("id"), None)
+                except TypeError:  # An unhashable id
+                    return None
+            if dimmer is None:
+                return None  # Replies to Light.Set and other requests
+            if "error" in data:
+                logging.error(f"Light.GetStatus failed on {dimmer}: {data['error']}")
+                return None
+            return self._merge(dimmer, data.get("result"))
+        if topic.endswith("/events/rpc") and data.get("method") in STATUS_METHODS:
+            params = data.get("params")
+            if isinstance(params, dict):
+                return self._merge(topic[:-len("/events/rpc")], params.get(LIGHT_COMPONENT))
+        return None
+
+    def _merge(self, dimmer, status):
+        if not isinstance(status, dict):
+            return None
+        changed = {key: status[key] for key in ("brightness", "output") if key in status}
+        if not changed:
+            return None
+        with self._lock:
+            state = self._state.setdefault(dimmer, {})
+            if all(state.get(key) == value for key, value in changed.items()):
+                return None
+            state.update(changed)
+        return dimmer
+
+    def get(self, dimmer):
+        """Returns the cached (brightness, output) of a dimmer, or None until both are known."""
+        with self._lock:
+            state = self._state.get(dimmer)
+            if state is None or "brightness" not in state or "output" not in state:
+                return None
+            return state["brightness"], state["output"]
@@ -0,0 +1,74 @@
+import math
+
+from publish_scheduler import MAX_COMMANDS_PER_SECOND
+
+FADE_DEVICE = "device"  # The dimmer ramps itself, via Light.Set transition_duration
+FADE_CLIENT = "client"  # Firmware without transitions: large jumps are sent as a series of steps
+FADE_OFF = "off"
+FADE_MODES = (FADE_DEVICE, FADE_CLIENT, FADE_OFF)
+FADE_TRANSITION = 1.0 / MAX_COMMANDS_PER_SECOND  # Seconds a ramp lasts on devices configure() was not called for
+INTERPOLATION_STEP = 8  # Largest brightness change per command in client-side fades
+
+class FadeEngine:
+    """
+    Turns the states released by the PublishScheduler into Light.Set commands that fade.
+
+    In device mode every brightness change of a light that stays on carries a
+    transition_duration equal to the dimmer's publish interval, so each ramp ends as the
+    next command arrives. The dimmer moves continuously while the knob turns, and one
+    command per interval replaces the steps the dimmer would otherwise need.
+
+    In client mode, for firmware without transitions, a brightness jump larger than
+    INTERPOLATION_STEP is cut into steps. The rest of the jump is resubmitted to the
+    scheduler, which releases it one interval later unless a newer knob state has
+    replaced it.
+    """
+
+    def __init__(self, mode=FADE_DEVICE, step=INTERPOLATION_STEP):
+        """
+        Initializes the FadeEngine.
+
+        :param mode: Default fade mode for devices not configured otherwise.
+        :param step: Largest brightness change per command in client mode.
+        """
+        self.mode = mode
+        self.step = step
+        self._modes = {}  # key -> (mode, transition)
+        self._sent = {}  # key -> (brightness, output) of the last command
+
+    def configure(self, key, mode, transition):
+        """
+        Sets the fade mode of one device.
+
+        :param key: The device (the RPC topic).
+        :param mode: One of FADE_MODES.
+        :param transition: Seconds a device-side ramp lasts, normally the publish interval.
+        :return: None
+        """
+        if mode not in FADE_MODES:
+            raise ValueError(f"Unknown fade mode {mode!r}, expected one of {FADE_MODES}")
+        self._modes[key] = (mode, transition)
+
+    def plan(self, key, state, now, scheduler):
+        """
+        Returns the command to send for a released state.
+
+        :param key: The device (the RPC topic).
+        :param state: The state released by the scheduler.
+        :param now: Current time in seconds.
+        :param scheduler: The PublishScheduler; client-mode fades resubmit the target to it.
+        :return: The state to publish, with "transition_duration" for device-side ramps.
+        """
+        mode, transition = self._modes.get(key, (self.mode, FADE_TRANSITION))
+        command = state
+        last = self._sent.get(key)
+        if mode != FADE_OFF and last is not None and last[1] and state["output"]:
+            delta = state["brightness"] - last[0]
+            if mode == FADE_DEVICE:
+                if delta:
+                    command = dict(state, transition_duration=transition)
+            elif abs(delta) > self.step:
+                command = dict(state, brightness=last[0] + int(math.copysign(self.step, delta)))
+                scheduler.submit(key, state, now)
+        self._sent[key] = (command["brightness"], command["output"])
+        return command
@@ -0,0 +1,68 @@
+import json
+
+import paho.mqtt.client as mqtt
+
+class FakeMessageInfo:
+    """Stand-in for paho's MQTTMessageInfo returned by publish()."""
+
+    __slots__ = ("rc", "mid")
+
+    def __init__(self, rc, mid):
+        self.rc = rc
+        self.mid = mid
+
+    def is_published(self):
+        return True
+
+class FakeClient:
+    """
+    In-process stand-in for paho.mqtt.client.Client used by the benchmarks.
+
+    publish() completes immediately: it counts the message, optionally keeps it in
+    self.published and fires on_publish synchronously, as paho does once a QoS 0
+    packet has been written. With rpc_replies, every RPC request is answered at once
+    through userdata.dispatch(), as a Shelly would answer on <src>/rpc.
+    """
+
+    def __init__(self, userdata=None, record=True, rpc_replies=False):
+        """
+        Initializes the FakeClient.
+
+        :param userdata: Passed to callbacks, as with paho.
+        :param record: Keep (topic, payload) of every publish in self.published.
+        :param rpc_replies: Answer each RPC request with an empty result.
+        """
+        self._userdata = userdata
+        self._record = record
+        self._rpc_replies = rpc_replies
+        self._mid = 0
+        self.published = []
+        self.publish_count = 0
+        self.subscriptions = []
+        self.on_connect = None
+        self.on_message = None
+        self.on_publish = None
+
+    def user_data_set(self, userdata):
+        self._userdata = userdata
+
+    def subscribe(self, topic, qos=0):
+        if isinstance(topic, list):
+            self.subscriptions.extend(name for name, _ in topic)
+        else:
+            self.subscriptions.append(topic)
+        self._mid += 1
+        return mqtt.MQTT_ERR_SUCCESS, self._mid
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self._mid += 1
+        self.publish_count += 1
+        if self._record:
+            self.published.append((topic, payload))
+        if self.on_publish is not None:
+            self.on_publish(self, self._userdata, self._mid)
+        if self._rpc_replies and topic.endswith("/rpc"):
+            request = json.loads(payload)
+            reply = json.dumps({"id": request["id"], "src": topic[:-len("/rpc")], "result": {}})
+            self._userdata.dispatch(f"{request['src']}/rpc", reply.encode("utf-8"))
+        return FakeMessageInfo(mqtt.MQTT_ERR_SUCCESS, self._mid)
@@ -1,44 +1,132 @@
-import requests
-import json
+"""
+Polls Light.GetStatus over HTTP on a fleet of Shelly dimmers and prints changes.
+
+All devices share one requests.Session, so each host keeps a keep-alive connection.
+Up to --max-in-flight requests run at once. Each device's poll interval adapts to how
+often its state changes: a change drops it back to --min-interval, and every unchanged
+poll stretches it by INTERVAL_BACKOFF, up to --max-interval. A line is printed only
+when a device's output or brightness changes, or when it stops or starts answering.
+
+    python get-light-status-http.py 192.168.68.102
+    python get-light-status-http.py --hosts-file dimmers.txt --max-in-flight 32
+"""
+import argparse
+import heapq
 import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
 
-# Set your Shelly device URL (ensure SHELLY is set as an environment variable or replace it with the actual IP)
-SHELLY = "192.168.68.102"  # Replace with your actual Shelly device IP or hostname
+import requests
+from requests.adapters import HTTPAdapter
 
-# Define the request URL
-url = f"http://{SHELLY}/rpc"
+# Set your Shelly device URL (replace it with the actual IP or hostname, or pass hosts on the command line)
+SHELLY = "192.168.68.102"
 
 # Define the JSON payload
 payload = {"id": 1, "method": "Light.GetStatus", "params": {"id": 0}}
 
-# Headers for the request
-headers = {"Content-Type": "application/json"}
+MAX_IN_FLIGHT = 16  # Requests running at once across the fleet
+MIN_POLL_INTERVAL = 1.0  # Seconds between polls of a device whose state is changing
+MAX_POLL_INTERVAL = 30.0  # Seconds between polls of an idle or unreachable device
+INTERVAL_BACKOFF = 1.5  # Factor applied to the interval after each unchanged poll
+REQUEST_TIMEOUT = (2, 3)  # Connect and read timeouts in seconds
 
-while True:
+def make_session(hosts):
+    """Creates a session that keeps one pooled keep-alive connection per host."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max(1, len(hosts)), pool_maxsize=1, max_retries=0)
+    session.mount("http://", adapter)
+    session.headers["Content-Type"] = "application/json"
+    return session
+
+def get_status(session, host):
+    """
+    Fetches Light.GetStatus from one device.
+
+    :return: (output, brightness), or an error string if the request failed.
+    """
     try:
-        # Send the request
-        response = requests.post(url, json=payload, headers=headers)
+        response = session.post(f"http://{host}/rpc", json=payload, timeout=REQUEST_TIMEOUT)
+        if response.status_code != 200:
+            return f"status code {response.status_code}"
+        result = response.json().get("result", {})
+        return result.get("output"), result.get("brightness")
+    except requests.RequestException as e:
+        return type(e).__name__  # The full text repeats the URL and pool details
+    except ValueError:
+        return "invalid JSON reply"
+
+def report(host, status):
+    """Prints one line for a changed device status."""
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    if isinstance(status, str):
+        print(f"[{timestamp}] {host} Error: {status}", flush=True)
+    else:
+        print(f"[{timestamp}] {host} Output: {status[0]}, Brightness: {status[1]}", flush=True)
 
-        # Ensure the request was successful
-        if response.status_code == 200:
-            data = response.json()
+def poll(hosts, max_in_flight=MAX_IN_FLIGHT, min_interval=MIN_POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL):
+    """
+    Polls the hosts forever, at most max_in_flight at a time.
 
-            # Extract output and brightness values
-            result = data.get("result", {})
-            output = result.get("output")
-            brightness = result.get("brightness")
+    :param hosts: List of device IPs or hostnames.
+    :param max_in_flight: Maximum number of concurrent requests.
+    :param min_interval: Poll interval of a device whose state just changed.
+    :param max_interval: Longest poll interval of an idle or failing device.
+    :return: None
+    """
+    session = make_session(hosts)
+    last = {}
+    interval = {host: min_interval for host in hosts}
+    # Spread the first round over one interval so the fleet does not poll in lockstep
+    start = time.monotonic()
+    due = [(start + min_interval * i / len(hosts), host) for i, host in enumerate(hosts)]
+    heapq.heapify(due)
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        while True:
+            now = time.monotonic()
+            while due and due[0][0] <= now and len(running) < max_in_flight:
+                _, host = heapq.heappop(due)
+                running[executor.submit(get_status, session, host)] = host
+            timeout = None
+            if due and len(running) < max_in_flight:
+                timeout = max(0.0, due[0][0] - now)
+            if not running:
+                time.sleep(timeout)
+                continue
+            done, _ = wait(running, timeout, return_when=FIRST_COMPLETED)
+            now = time.monotonic()
+            for future in done:
+                host = running.pop(future)
+                status = future.result()
+                if status != last.get(host):
+                    report(host, status)
+                    last[host] = status
+                    interval[host] = min_interval if not isinstance(status, str) else max_interval
+                else:
+                    interval[host] = min(max_interval, interval[host] * INTERVAL_BACKOFF)
+                heapq.heappush(due, (now + interval[host], host))
 
-            # Get the current timestamp
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+def load_hosts(path):
+    """Reads one host per line, skipping blank lines and # comments."""
+    with open(path, 'r') as file:
+        return [line.split('#', 1)[0].strip() for line in file if line.split('#', 1)[0].strip()]
 
-            # Print the values
-            print(f"[{timestamp}] Output: {output}, Brightness: {brightness}")
-        else:
-            print(f"Error: Received status code {response.status_code}")
+def main():
+    arg_parser = argparse.ArgumentParser(description="Poll Light.GetStatus on a fleet of Shelly dimmers")
+    arg_parser.add_argument("hosts", nargs="*", help="Device IPs or hostnames (default: SHELLY)")
+    arg_parser.add_argument("--hosts-file", help="File with one device IP or hostname per line")
+    arg_parser.add_argument("--max-in-flight", type=int, default=MAX_IN_FLIGHT, help="Concurrent requests")
+    arg_parser.add_argument("--min-interval", type=float, default=MIN_POLL_INTERVAL,
+                            help="Poll interval in seconds while a device is changing")
+    arg_parser.add_argument("--max-interval", type=float, default=MAX_POLL_INTERVAL,
+                            help="Longest poll interval in seconds for an idle device")
+    args = arg_parser.parse_args()
 
-    except Exception as e:
-        print(f"Error: {e}")
+    hosts = list(args.hosts)
+    if args.hosts_file:
+        hosts += load_hosts(args.hosts_file)
+    poll(list(dict.fromkeys(hosts or [SHELLY])), args.max_in_flight, args.min_interval, args.max_interval)
 
-    # Wait for 3 seconds before the next iteration
-    time.sleep(2)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
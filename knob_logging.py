@@ -0,0 +1,105 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+
+COUNT_CHUNK_SIZE = 1 << 16  # Bytes read at a time when counting existing log lines
+
+def count_lines(path):
+    """Counts the lines in a file with fixed-size reads, returning 0 if it does not exist."""
+    lines = 0
+    try:
+        with open(path, 'rb') as file:
+            while chunk := file.read(COUNT_CHUNK_SIZE):
+                lines += chunk.count(b'\n')
+    except FileNotFoundError:
+        pass
+    return lines
+
+class LineRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    File handler that keeps at most max_lines log lines on disk.
+
+    The live file is rotated to .1, .2, ... once it holds max_lines / (backup_count + 1)
+    lines, so the live file plus its backups never exceed max_lines. Rotation is a
+    rename. Unlike rewriting the file with its last N lines, it never reads the log back.
+    """
+
+    def __init__(self, filename, max_lines, backup_count=1, encoding=None, delay=False):
+        """
+        Initializes the LineRotatingFileHandler.
+
+        :param filename: Path of the live log file.
+        :param max_lines: Maximum number of lines kept across the live file and its backups.
+        :param backup_count: Number of rotated files to keep, at least 1.
+        """
+        super().__init__(filename, backupCount=max(1, backup_count), encoding=encoding, delay=delay)
+        self.lines_per_file = max(1, max_lines // (self.backupCount + 1))
+        self._lines = count_lines(self.baseFilename)
+
+    def doRollover(self):
+        super().doRollover()
+        self._lines = 0
+
+    def emit(self, record):
+        try:
+            msg = self.format(record)
+            lines = msg.count('\n') + 1
+            if self._lines and self._lines + lines > self.lines_per_file:
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(msg + self.terminator)
+            self.flush()
+            self._lines += lines
+        except Exception:
+            self.handleError(record)
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that enqueues records untouched.
+
+    The stock handler formats the message in the calling thread so records can be
+    pickled. The queue here never leaves the process, so message formatting is left to
+    the listener thread.
+    """
+
+    def prepare(self, record):
+        return record
+
+class SafeStopQueueListener(logging.handlers.QueueListener):
+    """QueueListener that tracks whether it is running, so stop() may be called more than once."""
+
+    def __init__(self, log_queue, *handlers, respect_handler_level=False):
+        super().__init__(log_queue, *handlers, respect_handler_level=respect_handler_level)
+        self.running = False
+
+    def start(self):
+        super().start()
+        self.running = True
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            super().stop()
+
+def start_queue_logging(logger, handlers):
+    """
+    Moves the given handlers behind a QueueHandler on the logger.
+
+    Records are put on an unbounded queue by the calling thread and formatted and written
+    by a QueueListener thread, so neither formatting nor a slow disk blocks the MQTT
+    callbacks. The listener is flushed and stopped at exit.
+
+    :return: The started QueueListener.
+    """
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(DeferredQueueHandler(log_queue))
+    listener = SafeStopQueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(stop_queue_logging, listener)
+    return listener
+
+def stop_queue_logging(listener):
+    """Flushes and stops a listener from start_queue_logging(); safe to call more than once."""
+    listener.stop()
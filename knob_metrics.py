@@ -0,0 +1,211 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SUB_BUCKET_BITS = 4  # 16 linear sub-buckets per power of two, roughly 6% precision
+MAX_TRACKED_VALUE_NS = 1 << 40  # About 18 minutes; larger values land in the top bucket
+MAX_TRACKED_PUBLISHES = 1024  # Bound on publishes waiting for their on_publish ack
+STAGES = ("decode", "dispatch", "state_change", "worker_wakeup", "publish", "ack")
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+OTHER_ACTION = "other"  # Counter label shared by all actions outside the dispatch table
+
+class LatencyHistogram:
+    """
+    HDR-style log-linear histogram of nanosecond latencies.
+
+    Values are bucketed by their power of two and then by the next SUB_BUCKET_BITS
+    bits, so every recorded value is kept to within a few percent at any magnitude.
+    Recording is a bit_length call and a list increment.
+    """
+
+    def __init__(self):
+        self._sub_count = 1 << SUB_BUCKET_BITS
+        self._counts = [0] * self._index(MAX_TRACKED_VALUE_NS - 1) + [0]
+        self._max_index = len(self._counts) - 1
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def _index(self, value):
+        shift = value.bit_length() - SUB_BUCKET_BITS - 1
+        if shift <= 0:
+            return value
+        return ((shift + 1) << SUB_BUCKET_BITS) + (value >> shift) - self._sub_count
+
+    def _value_at(self, index):
+        """Returns the midpoint of the bucket at index."""
+        if index < 2 * self._sub_count:
+            return index
+        shift = (index >> SUB_BUCKET_BITS) - 1
+        low = ((index & (self._sub_count - 1)) + self._sub_count) << shift
+        return low + (1 << shift) // 2
+
+    def record(self, value_ns):
+        """Records one latency in nanoseconds."""
+        if value_ns < 0:
+            value_ns = 0
+        index = self._index(value_ns)
+        if index > self._max_index:
+            index = self._max_index
+        self._counts[index] += 1
+        self.count += 1
+        self.total += value_ns
+        if value_ns > self.max:
+            self.max = value_ns
+
+    def percentile(self, quantile):
+        """Returns the latency in nanoseconds at the given quantile (0.0 - 1.0)."""
+        if self.count == 0:
+            return 0
+        target = quantile * self.count
+        seen = 0
+        for index, count in enumerate(self._counts):
+            seen += count
+            if count and seen >= target:
+                return min(self._value_at(index), self.max)
+        return self.max
+
+    def reset(self):
+        """Clears all recorded values."""
+        self._counts = [0] * len(self._counts)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+def escape_label(value):
+    """Escapes a Prometheus label value (backslash, double quote and newline)."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Metrics:
+    """
+    Stage latency histograms and per-action counters for the knob -> Light.Set path.
+
+    Every stage is measured from the moment the knob message was received:
+    decode (JSON decoded), dispatch (parser handler returned), state_change (parser marked
+    dirty), worker_wakeup (publisher picked the route up), publish (client.publish returned)
+    and ack (paho on_publish fired). Updates are not locked; a rare lost increment under
+    contention is accepted to keep the hot path cheap.
+    """
+
+    def __init__(self):
+        self.stages = {stage: LatencyHistogram() for stage in STAGES}
+        self.actions = {}
+        self.messages = 0
+        self.publishes = 0
+        self._collectors = {}
+        self._inflight = OrderedDict()
+        self._early_acks = OrderedDict()
+        self._ack_lock = threading.Lock()
+
+    def observe(self, stage, since_ns):
+        """Records the time elapsed since since_ns for a stage."""
+        self.stages[stage].record(time.perf_counter_ns() - since_ns)
+
+    def count_action(self, action):
+        """
+        Counts one received knob message by its action.
+
+        Callers pass OTHER_ACTION for anything outside the dispatch table, so a knob
+        sending unexpected actions cannot grow the label set without bound.
+        """
+        self.messages += 1
+        self.actions[action] = self.actions.get(action, 0) + 1
+
+    def add_collector(self, name, collect):
+        """Registers a callable returning a dict of extra numeric values to export."""
+        self._collectors[name] = collect
+
+    def track_publish(self, mid, event_ns):
+        """Remembers a publish so its on_publish ack can be timed against the knob event."""
+        self.publishes += 1
+        with self._ack_lock:
+            if self._early_acks.pop(mid, None) is not None:
+                self.observe("ack", event_ns)
+                return
+            self._inflight[mid] = event_ns
+            if len(self._inflight) > MAX_TRACKED_PUBLISHES:
+                self._inflight.popitem(last=False)
+
+    def publish_acked(self, mid):
+        """Records the ack latency for a tracked publish (called from on_publish)."""
+        with self._ack_lock:
+            event_ns = self._inflight.pop(mid, None)
+            if event_ns is None:
+                # on_publish can fire before publish() has returned the mid
+                self._early_acks[mid] = True
+                if len(self._early_acks) > MAX_TRACKED_PUBLISHES:
+                    self._early_acks.popitem(last=False)
+                return
+        self.observe("ack", event_ns)
+
+    def render_prometheus(self):
+        """Renders all metrics in the Prometheus text exposition format."""
+        lines = ["# TYPE smart_knob_stage_latency_seconds summary"]
+        for stage, histogram in self.stages.items():
+            for quantile in QUANTILES:
+                lines.append(f'smart_knob_stage_latency_seconds{{stage="{stage}",quantile="{quantile}"}} '
+                             f'{histogram.percentile(quantile) / 1e9:.9f}')
+            lines.append(f'smart_knob_stage_latency_seconds_sum{{stage="{stage}"}} {histogram.total / 1e9:.9f}')
+            lines.append(f'smart_knob_stage_latency_seconds_count{{stage="{stage}"}} {histogram.count}')
+        lines.append("# TYPE smart_knob_actions_total counter")
+        for action, count in list(self.actions.items()):
+            lines.append(f'smart_knob_actions_total{{action="{escape_label(action)}"}} {count}')
+        lines.append("# TYPE smart_knob_messages_total counter")
+        lines.append(f"smart_knob_messages_total {self.messages}")
+        lines.append("# TYPE smart_knob_publishes_total counter")
+        lines.append(f"smart_knob_publishes_total {self.publishes}")
+        for name, collect in self._collectors.items():
+            for key, value in collect().items():
+                lines.append(f"smart_knob_{name}_{key} {value}")
+        return "\n".join(lines) + "\n"
+
+    def format_summary(self):
+        """Returns a one-line summary of the stage percentiles in milliseconds and the counters."""
+        parts = []
+        for stage, histogram in self.stages.items():
+            if histogram.count:
+                parts.append(f"{stage} p50={histogram.percentile(0.5) / 1e6:.3f}ms "
+                             f"p99={histogram.percentile(0.99) / 1e6:.3f}ms n={histogram.count}")
+        parts.append(f"actions={dict(self.actions)}")
+        for name, collect in self._collectors.items():
+            parts.append(f"{name}={collect()}")
+        return " | ".join(parts)
+
+def start_http_server(metrics, port, host="127.0.0.1"):
+    """
+    Serves metrics.render_prometheus() on http://host:port/metrics from a daemon thread.
+
+    :return: The running ThreadingHTTPServer.
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
+
+def start_stats_dumper(metrics, interval):
+    """Prints metrics.format_summary() every interval seconds from a daemon thread."""
+    def dump():
+        while True:
+            time.sleep(interval)
+            print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {metrics.format_summary()}", flush=True)
+
+    thread = threading.Thread(target=dump, daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,189 @@
+"""
+Minimal MQTT 3.1.1 broker for local tests and soak runs, so no live broker is needed.
+
+Supports CONNECT, PUBLISH at QoS 0 and 1 (acknowledged, delivered at QoS 0), SUBSCRIBE
+and UNSUBSCRIBE with + and # wildcards, PINGREQ and DISCONNECT. There are no retained
+messages, persistent sessions or authentication.
+
+    python mini_broker.py --port 1883
+"""
+import argparse
+import asyncio
+import logging
+import threading
+
+CONNECT, CONNACK, PUBLISH, PUBACK, SUBSCRIBE, SUBACK = 1, 2, 3, 4, 8, 9
+UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 10, 11, 12, 13, 14
+
+def topic_matches(topic_filter, topic):
+    """Returns True if an MQTT topic filter with + and # wildcards matches a topic."""
+    filter_levels = topic_filter.split('/')
+    topic_levels = topic.split('/')
+    for index, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if index >= len(topic_levels) or (level != '+' and level != topic_levels[index]):
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+def encode_length(length):
+    """Encodes an MQTT remaining length."""
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+class MiniBroker:
+    """
+    An asyncio MQTT broker serving any number of clients on one event loop.
+
+    Every PUBLISH is written once to each client with a matching subscription. Filters
+    without wildcards are looked up by topic, so thousands of per-device subscriptions
+    cost one dict lookup per message; only wildcard filters are matched one by one. The
+    counters messages_in and messages_out are kept for load reports.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0):
+        """
+        Initializes the MiniBroker.
+
+        :param host: Address to listen on.
+        :param port: Port to listen on; 0 picks a free one, see self.port once started.
+        """
+        self.host = host
+        self.port = port
+        self.messages_in = 0
+        self.messages_out = 0
+        self._subscriptions = {}  # writer -> set of topic filters
+        self._exact = {}  # topic -> set of writers
+        self._wildcard = {}  # topic filter with + or # -> set of writers
+
+    @property
+    def clients(self):
+        return len(self._subscriptions)
+
+    def _subscribe(self, writer, topic_filter):
+        self._subscriptions[writer].add(topic_filter)
+        index = self._wildcard if '+' in topic_filter or '#' in topic_filter else self._exact
+        index.setdefault(topic_filter, set()).add(writer)
+
+    def _unsubscribe(self, writer, topic_filter):
+        self._subscriptions[writer].discard(topic_filter)
+        for index in (self._exact, self._wildcard):
+            writers = index.get(topic_filter)
+            if writers is not None:
+                writers.discard(writer)
+                if not writers:
+                    del index[topic_filter]
+
+    async def serve(self, started=None):
+        """
+        Serves clients until cancelled.
+
+        :param started: Optional threading.Event set once the port is bound.
+        :return: None
+        """
+        server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = server.sockets[0].getsockname()[1]
+        logging.info(f"MQTT broker listening on {self.host}:{self.port}")
+        if started is not None:
+            started.set()
+        async with server:
+            await server.serve_forever()
+
+    def start_in_thread(self):
+        """Runs the broker on its own event loop in a daemon thread and returns the bound port."""
+        started = threading.Event()
+        threading.Thread(target=asyncio.run, args=(self.serve(started),), name="mini-broker", daemon=True).start()
+        started.wait()
+        return self.port
+
+    async def _read_packet(self, reader):
+        header = (await reader.readexactly(1))[0]
+        length, multiplier = 0, 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7f) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header, await reader.readexactly(length)
+
+    async def _handle(self, reader, writer):
+        self._subscriptions[writer] = set()
+        try:
+            while True:
+                header, body = await self._read_packet(reader)
+                packet_type = header >> 4
+                if packet_type == CONNECT:
+                    writer.write(bytes([CONNACK << 4, 2, 0, 0]))
+                elif packet_type == PUBLISH:
+                    self._publish(writer, header, body)
+                elif packet_type == SUBSCRIBE:
+                    filters = self._filters(body[2:], with_qos=True)
+                    for topic_filter in filters:
+                        self._subscribe(writer, topic_filter)
+                    writer.write(bytes([SUBACK << 4]) + encode_length(2 + len(filters)) + body[:2] + bytes(len(filters)))
+                elif packet_type == UNSUBSCRIBE:
+                    for topic_filter in self._filters(body[2:], with_qos=False):
+                        self._unsubscribe(writer, topic_filter)
+                    writer.write(bytes([UNSUBACK << 4, 2]) + body[:2])
+                elif packet_type == PINGREQ:
+                    writer.write(bytes([PINGRESP << 4, 0]))
+                elif packet_type == DISCONNECT:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for topic_filter in list(self._subscriptions[writer]):
+                self._unsubscribe(writer, topic_filter)
+            del self._subscriptions[writer]
+            writer.close()
+
+    @staticmethod
+    def _filters(payload, with_qos):
+        filters = []
+        index = 0
+        while index < len(payload):
+            length = int.from_bytes(payload[index:index + 2], 'big')
+            filters.append(payload[index + 2:index + 2 + length].decode())
+            index += 2 + length + (1 if with_qos else 0)
+        return filters
+
+    def _publish(self, writer, header, body):
+        self.messages_in += 1
+        qos = (header >> 1) & 3
+        topic_length = int.from_bytes(body[:2], 'big')
+        topic = body[2:2 + topic_length].decode()
+        payload_start = 2 + topic_length
+        if qos:
+            writer.write(bytes([PUBACK << 4, 2]) + body[payload_start:payload_start + 2])
+            payload_start += 2
+        payload = body[payload_start:]
+        packet = bytes([PUBLISH << 4]) + encode_length(2 + topic_length + len(payload)) + body[:2 + topic_length] + payload
+        subscribers = set(self._exact.get(topic, ()))
+        for topic_filter, writers in self._wildcard.items():
+            if topic_matches(topic_filter, topic):
+                subscribers |= writers
+        for subscriber in subscribers:
+            subscriber.write(packet)
+        self.messages_out += len(subscribers)
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Minimal local MQTT broker")
+    arg_parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    arg_parser.add_argument("--port", type=int, default=1883, help="Port to listen on")
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    try:
+        asyncio.run(MiniBroker(args.host, args.port).serve())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import heapq
+import time
+
+MAX_COMMANDS_PER_SECOND = 5  # Default rate cap per Shelly device
+
+class PublishScheduler:
+    """
+    Coalesces state updates per device and releases them under a per-device rate cap.
+
+    Only the newest item submitted for a device is kept. An idle device is released
+    immediately; a busy one is released no earlier than 1/max_rate seconds after its
+    previous command, so the final value always goes out within one interval of the
+    last submit. The scheduler does no threading of its own: the caller submits items,
+    sleeps until next_deadline() and then collects pop_due().
+    """
+
+    def __init__(self, max_rate=MAX_COMMANDS_PER_SECOND, clock=time.monotonic):
+        """
+        Initializes the PublishScheduler.
+
+        :param max_rate: Default maximum number of commands per second per device.
+        :param clock: Monotonic clock returning seconds, used when no time is passed in.
+        """
+        self._default_interval = 1.0 / max_rate
+        self._clock = clock
+        self._intervals = {}
+        self._last_sent = {}
+        self._pending = {}
+        self._heap = []
+        self._seq = 0
+        self.submitted = 0
+        self.coalesced = 0
+        self.sent = 0
+
+    def set_rate(self, key, max_rate):
+        """Overrides the rate cap for one device; None restores the default cap."""
+        if max_rate is None:
+            self._intervals.pop(key, None)
+        else:
+            self._intervals[key] = 1.0 / max_rate
+
+    def interval(self, key):
+        """Returns the minimum seconds between two commands to a device."""
+        return self._intervals.get(key, self._default_interval)
+
+    def submit(self, key, item, now=None):
+        """
+        Queues the newest item for a device, replacing any item still waiting.
+
+        :param key: The device the item is for (the RPC topic).
+        :param item: The state to send.
+        :param now: Current time in seconds, defaults to the scheduler clock.
+        :return: None
+        """
+        self.submitted += 1
+        if key in self._pending:
+            self._pending[key] = item
+            self.coalesced += 1
+            return
+        if now is None:
+            now = self._clock()
+        self._pending[key] = item
+        due = now
+        last_sent = self._last_sent.get(key)
+        if last_sent is not None:
+            due = max(now, last_sent + self._intervals.get(key, self._default_interval))
+        self._seq += 1
+        heapq.heappush(self._heap, (due, self._seq, key))
+
+    def next_deadline(self):
+        """Returns the time the next item becomes due, or None if nothing is queued."""
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now=None):
+        """
+        Removes and returns every item whose time has come.
+
+        :param now: Current time in seconds, defaults to the scheduler clock.
+        :return: List of (key, item) tuples in due order.
+        """
+        if now is None:
+            now = self._clock()
+        due = []
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            key = heapq.heappop(heap)[2]
+            due.append((key, self._pending.pop(key)))
+            self._last_sent[key] = now
+        self.sent += len(due)
+        return due
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __contains__(self, key):
+        return key in self._pending
+
+    def stats(self):
+        """Returns the submitted, coalesced and sent counters."""
+        return {"submitted": self.submitted, "coalesced": self.coalesced, "sent": self.sent, "pending": len(self._pending)}
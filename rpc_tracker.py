@@ -0,0 +1,147 @@
+import itertools
+import logging
+import threading
+import time
+
+from knob_metrics import LatencyHistogram
+
+RPC_TIMEOUT = 2.0  # Seconds to wait for a Light.Set response before retrying
+MAX_RPC_RETRIES = 2  # Retries of the newest command per dimmer before giving up
+MAX_INFLIGHT_RPCS = 1024  # Bound on requests waiting for a response
+
+# Request ids shared by every RPC the controller sends, so replies on <src>/rpc never collide
+next_request_id = itertools.count(1).__next__
+
+class RpcTracker:
+    """
+    Tracks Light.Set requests until the Shelly RPC response with the same id arrives.
+
+    Only the newest request per dimmer is in flight: sending a new one supersedes the
+    previous one, so a lost command is never retried over a newer brightness. A request
+    with no response after RPC_TIMEOUT is handed back by expired() to be sent again, up
+    to MAX_RPC_RETRIES times. Responses are timed into a LatencyHistogram.
+
+    Like PublishScheduler, the tracker runs no thread of its own: the publisher calls
+    expired() once next_deadline() has passed. acknowledge() may be called from the MQTT
+    network thread.
+    """
+
+    def __init__(self, timeout=RPC_TIMEOUT, max_retries=MAX_RPC_RETRIES, clock=time.monotonic):
+        """
+        Initializes the RpcTracker.
+
+        :param timeout: Seconds to wait for a response.
+        :param max_retries: Number of times an unanswered request is resent.
+        :param clock: Monotonic clock returning seconds.
+        """
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._inflight = {}  # request id -> [key, state, sent at, retries]
+        self._by_key = {}  # key -> request id of its newest request
+        self._retrying = {}  # key -> (state, retries) handed out by expired() and not yet resent
+        self.latency = LatencyHistogram()
+        self.sent = 0
+        self.acked = 0
+        self.errors = 0
+        self.retried = 0
+        self.superseded = 0
+        self.failed = 0
+
+    def begin(self, key, state, now=None):
+        """
+        Registers a request about to be sent.
+
+        :param key: The device (the RPC topic).
+        :param state: The target state, resent as it is on a retry.
+        :param now: Current time in seconds, defaults to the tracker clock.
+        :return: The request id to put in the payload.
+        """
+        request_id = next_request_id()
+        if now is None:
+            now = self._clock()
+        with self._lock:
+            retried = self._retrying.pop(key, None)
+            retries = retried[1] if retried is not None and retried[0] is state else 0
+            previous = self._by_key.pop(key, None)
+            if previous is not None and self._inflight.pop(previous, None) is not None:
+                self.superseded += 1
+            self._inflight[request_id] = [key, state, now, retries]
+            self._by_key[key] = request_id
+            if len(self._inflight) > MAX_INFLIGHT_RPCS:
+                oldest = next(iter(self._inflight))
+                self._by_key.pop(self._inflight.pop(oldest)[0], None)
+                self.failed += 1
+            self.sent += 1
+        return request_id
+
+    def acknowledge(self, data, now=None):
+        """
+        Completes the request a decoded RPC response belongs to.
+
+        :param data: The decoded response, {"id": ..., "result": ...} or {"id": ..., "error": ...}.
+        :param now: Current time in seconds, defaults to the tracker clock.
+        :return: The key of the request the response belongs to, or None if it is not tracked.
+        """
+        if now is None:
+            now = self._clock()
+        with self._lock:
+            try:
+                entry = self._inflight.pop(data.get("id"), None)
+            except TypeError:  # An unhashable id
+                return None
+            if entry is None:
+                return None
+            if self._by_key.get(entry[0]) == data.get("id"):
+                del self._by_key[entry[0]]
+            if "error" in data:
+                self.errors += 1
+            else:
+                self.acked += 1
+        self.latency.record(int((now - entry[2]) * 1e9))
+        if "error" in data:
+            logging.error(f"Light.Set on {entry[0]} failed: {data['error']}")
+        return entry[0]
+
+    def next_deadline(self):
+        """Returns the time the oldest request times out, or None if none is in flight."""
+        with self._lock:
+            if not self._inflight:
+                return None
+            # Requests are kept in the order they were sent
+            return self._inflight[next(iter(self._inflight))][2] + self.timeout
+
+    def expired(self, now=None):
+        """
+        Removes the requests that timed out.
+
+        :param now: Current time in seconds, defaults to the tracker clock.
+        :return: List of (key, state) to send again; requests out of retries are dropped.
+        """
+        if now is None:
+            now = self._clock()
+        retry = []
+        with self._lock:
+            while self._inflight:
+                request_id = next(iter(self._inflight))
+                key, state, sent_at, retries = self._inflight[request_id]
+                if now - sent_at < self.timeout:
+                    break
+                del self._inflight[request_id]
+                del self._by_key[key]
+                if retries < self.max_retries:
+                    self.retried += 1
+                    self._retrying[key] = (state, retries + 1)
+                    retry.append((key, state))
+                else:
+                    self.failed += 1
+                    logging.error(f"No response from {key} after {retries + 1} attempts, giving up")
+        return retry
+
+    def stats(self):
+        """Returns the request counters and the response latency percentiles in seconds."""
+        return {"sent": self.sent, "acked": self.acked, "errors": self.errors, "retried": self.retried,
+                "superseded": self.superseded, "failed": self.failed, "inflight": len(self._inflight),
+                "ack_p50_seconds": self.latency.percentile(0.5) / 1e9,
+                "ack_p99_seconds": self.latency.percentile(0.99) / 1e9}
@@ -0,0 +1,279 @@
+"""
+Sharded mode: the knobs are spread over worker processes, each running the controller.
+
+    python smart_knob_mqtt.py --shards 4
+
+Every shard is a full controller process with its own broker connection. It subscribes
+to the exact topics of its own knobs and dimmers only, so the broker delivers each
+message straight to the one process that handles it: nothing is decoded twice or handed
+between processes, and parsing and dispatch run on as many cores as there are shards.
+Each knob and dimmer lives in exactly one shard, and MQTT keeps the messages of one
+connection in order, so every device sees its messages in order.
+
+Knobs are assigned to shards on a consistent hash ring, so changing the mapping file or
+the shard count moves as few knobs as possible. Knobs that drive a common dimmer are
+kept in one shard, so the dimmer's rate cap, fades and dedup state stay in one place.
+
+The supervisor process owns the mapping file: it watches it and sends each shard its
+part over a pipe, and restarts shards that exit. Each shard sends its RPC requests as
+<RPC_SRC>-<index> and keeps its own log and state file, e.g. smart_knob_mqtt.shard0.log.
+"""
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+SHARD_VIRTUAL_NODES = 64  # Points per shard on the hash ring; more points spread the knobs more evenly
+SUPERVISOR_POLL_INTERVAL = 1.0  # Seconds between the supervisor's config and liveness checks
+SHARD_RESTART_DELAY = 5.0  # Seconds before a shard that exited is started again
+
+def stable_hash(key):
+    """Returns a 64-bit hash of a string that is the same in every process and run."""
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), 'big')
+
+class HashRing:
+    """
+    Consistent hash ring mapping keys to shard indexes.
+
+    Each shard owns SHARD_VIRTUAL_NODES points on the ring and a key belongs to the shard
+    owning the next point at or after the key's hash. Adding a shard takes over only the
+    keys that land on its new points, about 1/n of them.
+    """
+
+    def __init__(self, shards, replicas=SHARD_VIRTUAL_NODES):
+        """
+        Initializes the HashRing.
+
+        :param shards: Number of shards.
+        :param replicas: Points per shard.
+        """
+        self.shards = shards
+        points = sorted((stable_hash(f"shard-{shard}-{replica}"), shard)
+                        for shard in range(shards) for replica in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._owners = [shard for _, shard in points]
+
+    def shard(self, key):
+        """Returns the shard index a key belongs to."""
+        index = bisect.bisect(self._hashes, stable_hash(key)) % len(self._hashes)
+        return self._owners[index]
+
+def device_groups(devices):
+    """
+    Groups the mapping entries that drive a common dimmer.
+
+    :param devices: The mapping table, as in load_config().
+    :return: List of (key, entries) per group, the key being the group's first knob name.
+    """
+    parent = list(range(len(devices)))
+
+    def find(index):
+        while parent[index] != index:
+            parent[index] = parent[parent[index]]
+            index = parent[index]
+        return index
+
+    owner = {}  # dimmer -> index of an entry driving it
+    for index, entry in enumerate(devices):
+        dimmers = entry.get("dimmers") or entry.get("dimmer")
+        for member in dimmers if isinstance(dimmers, list) else [dimmers]:
+            dimmer = member["dimmer"] if isinstance(member, dict) else member
+            if dimmer in owner:
+                parent[find(index)] = find(owner[dimmer])
+            else:
+                owner[dimmer] = index
+    groups = {}
+    for index, entry in enumerate(devices):
+        groups.setdefault(find(index), []).append(entry)
+    return [(min(entry["knob"] for entry in entries), entries) for entries in groups.values()]
+
+def assign_devices(devices, ring):
+    """
+    Splits a mapping table over the shards of a hash ring.
+
+    :return: List with the mapping entries of each shard, in their order in the table.
+    """
+    shard_of = {}
+    for key, entries in device_groups(devices):
+        shard = ring.shard(key)
+        for entry in entries:
+            shard_of[id(entry)] = shard
+    assigned = [[] for _ in range(ring.shards)]
+    for entry in devices:
+        assigned[shard_of[id(entry)]].append(entry)
+    return assigned
+
+def shard_path(path, index):
+    """Returns the per-shard variant of a file name, e.g. state.jsonl -> state.shard0.jsonl; '' stays ''."""
+    if not path:
+        return path
+    root, extension = os.path.splitext(path)
+    return f"{root}.shard{index}{extension}"
+
+class ShardConfigFeed:
+    """
+    The config of one shard, as sent by the supervisor.
+
+    Offers the part of the ConfigWatcher interface reload_config() uses, so a shard
+    applies new configs exactly like the unsharded controller. The shard exits once the
+    supervisor is gone.
+    """
+
+    def __init__(self, connection, config, path):
+        """
+        Initializes the ShardConfigFeed.
+
+        :param connection: The shard's end of the supervisor pipe.
+        :param config: The config the shard starts with.
+        :param path: The mapping file, for log messages.
+        """
+        self._connection = connection
+        self.config = config
+        self.path = path
+
+    def poll(self):
+        """Returns the newest config sent by the supervisor, or None if none arrived."""
+        config = None
+        try:
+            while self._connection.poll():
+                config = self._connection.recv()
+        except (EOFError, OSError):
+            logging.error("Supervisor exited, stopping the shard")
+            sys.exit(0)
+        if config is not None:
+            self.config = config
+        return config
+
+def run_shard(index, config, args, connection):
+    """
+    Runs one shard: a controller for the knobs in config, fed new configs through connection.
+
+    The process entry point of every shard.
+
+    :return: Does not return.
+    """
+    import smart_knob_mqtt as controller
+    controller.LOG_FILE_PATH = shard_path(controller.LOG_FILE_PATH, index)
+    controller.setup_logging()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C reaches the whole group; the supervisor stops the shards
+    controller.set_rpc_source(f"{controller.RPC_SRC}-{index}")
+    controller.apply_brightness_limits(config["brightness"])
+    args.state_file = shard_path(args.state_file, index)
+    if args.metrics_port:
+        args.metrics_port += index
+    logging.info(f"Shard {index} starting with {len(config['devices'])} knobs")
+    controller.run_threaded(config, args, ShardConfigFeed(connection, config, args.map), wildcard_topics=False)
+
+class ShardSupervisor:
+    """
+    Starts the shard processes, hands them their part of the config and restarts them.
+
+    Like the other periodic work in the controller it runs no thread of its own: the
+    caller calls poll() every SUPERVISOR_POLL_INTERVAL seconds.
+    """
+
+    def __init__(self, config, args, watcher=None, context=None):
+        """
+        Initializes the ShardSupervisor.
+
+        :param config: The config from load_config().
+        :param args: The parsed command line; args.shards is the number of shards.
+        :param watcher: Optional ConfigWatcher of the mapping file.
+        :param context: multiprocessing context; "spawn" by default, as the supervisor
+                        already runs threads that a forked child would inherit half-way.
+        """
+        self.args = args
+        self.watcher = watcher
+        self.ring = HashRing(args.shards)
+        self._context = context or multiprocessing.get_context("spawn")
+        self._configs = self._split(config)
+        self._processes = [None] * args.shards
+        self._connections = [None] * args.shards
+        self._restart_at = [None] * args.shards
+
+    def _split(self, config):
+        return [dict(config, devices=devices) for devices in assign_devices(config["devices"], self.ring)]
+
+    def start(self):
+        """Starts every shard."""
+        for index in range(len(self._processes)):
+            self._start(index)
+        logging.warning(f"Started {len(self._processes)} shards with "
+                        f"{', '.join(str(len(config['devices'])) for config in self._configs)} knobs")
+
+    def _start(self, index):
+        parent_end, child_end = self._context.Pipe()
+        process = self._context.Process(target=run_shard, name=f"shard-{index}", daemon=True,
+                                        args=(index, self._configs[index], self.args, child_end))
+        process.start()
+        child_end.close()
+        self._processes[index] = process
+        self._connections[index] = parent_end
+        self._restart_at[index] = None
+
+    def distribute(self, config):
+        """Sends each shard whose part of the config changed its new part."""
+        configs = self._split(config)
+        for index, shard_config in enumerate(configs):
+            if shard_config == self._configs[index]:
+                continue
+            self._configs[index] = shard_config
+            try:
+                self._connections[index].send(shard_config)
+            except OSError:
+                pass  # The shard is down and gets the new config when it is restarted
+        logging.info(f"Distributed {len(config['devices'])} knobs over {len(configs)} shards")
+
+    def poll(self, now=None):
+        """Applies config changes and restarts shards that exited."""
+        if now is None:
+            now = time.monotonic()
+        if self.watcher is not None:
+            config = self.watcher.poll(now)
+            if config is not None:
+                self.distribute(config)
+        for index, process in enumerate(self._processes):
+            if process.is_alive():
+                continue
+            if self._restart_at[index] is None:
+                logging.error(f"Shard {index} exited with code {process.exitcode}, "
+                              f"restarting in {SHARD_RESTART_DELAY:.0f} s")
+                self._connections[index].close()
+                self._restart_at[index] = now + SHARD_RESTART_DELAY
+            elif now >= self._restart_at[index]:
+                logging.warning(f"Restarting shard {index}")
+                self._start(index)
+
+    def stop(self):
+        """Stops every shard with SIGTERM, so they flush their state, and waits for them."""
+        for process in self._processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self._processes:
+            if process is not None:
+                process.join()
+
+def run_supervisor(config, args, watcher=None):
+    """
+    Runs the sharded controller until the supervisor is stopped.
+
+    :param config: The config from load_config().
+    :param args: The parsed command line.
+    :param watcher: Optional ConfigWatcher of the mapping file.
+    :return: None
+    """
+    supervisor = ShardSupervisor(config, args, watcher)
+    supervisor.start()
+    try:
+        while True:
+            time.sleep(SUPERVISOR_POLL_INTERVAL)
+            supervisor.poll()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        supervisor.stop()
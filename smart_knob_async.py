@@ -0,0 +1,254 @@
+import asyncio
+import logging
+import time
+
+import paho.mqtt.client as mqtt
+
+from publish_scheduler import PublishScheduler
+from rpc_tracker import RpcTracker
+from smart_knob_mqtt import (KnobRouter, SmartKnobParser, MQTT_BROKER, MQTT_PORT, backoff_delays, earliest,
+                             on_connect, on_disconnect, on_message, on_publish, open_device_states, open_state_store,
+                             release_due, reload_config, report_scheduler_stats, retry_expired, setup_metrics,
+                             SCHEDULER_STATS_INTERVAL)
+
+MISC_LOOP_INTERVAL = 1  # Seconds between paho keepalive/housekeeping calls
+
+class AsyncSmartKnobParser(SmartKnobParser):
+    """
+    SmartKnobParser for the asyncio controller.
+
+    Every message is handled on the event loop thread, so the state is plain attributes
+    with no Condition round-trips.
+    """
+
+    @property
+    def brightness(self):
+        """Gets the current brightness value."""
+        return self._brightness
+
+    @brightness.setter
+    def brightness(self, value):
+        """Sets the brightness value and marks the state as dirty."""
+        self._brightness = value
+        self._dirty = True
+        if self._on_dirty is not None:
+            self._on_dirty(self)
+
+    @property
+    def output(self):
+        """Gets the current output state."""
+        return self._output
+
+    @output.setter
+    def output(self, value):
+        """Sets the output state and marks the state as dirty."""
+        self._output = value
+        self._dirty = True
+        if self._on_dirty is not None:
+            self._on_dirty(self)
+
+    @property
+    def dirty(self):
+        """Gets the dirty state."""
+        return self._dirty
+
+    @dirty.setter
+    def dirty(self, value):
+        """Sets the dirty state."""
+        self._dirty = value
+
+    def report_state(self):
+        """Reports the current brightness and output state and clears the dirty flag."""
+        self._dirty = False
+        return {"brightness": self._brightness, "output": self._output}
+
+class AsyncKnobRouter(KnobRouter):
+    """KnobRouter whose dirty queue wakes an asyncio task instead of a thread."""
+
+    def __init__(self, device_map, metrics=None, state_store=None, device_states=None, rpc_tracker=None):
+        self.wakeup = asyncio.Event()
+        super().__init__(device_map, parser_factory=AsyncSmartKnobParser, metrics=metrics,
+                         state_store=state_store, device_states=device_states, rpc_tracker=rpc_tracker)
+
+    def _mark_dirty(self, route):
+        """Queues a route for publishing and wakes the publisher task."""
+        route.changed_at = time.monotonic()
+        if self.metrics is not None:
+            self.metrics.observe("state_change", route.event_ns)
+        self._pending[route] = None
+        self.wakeup.set()
+
+    def set_online(self, online):
+        """Records whether the broker connection is up and wakes the publisher task."""
+        self.online = online
+        self.wakeup.set()
+
+    def take_dirty(self, timeout=None):
+        """Returns the dirty routes without blocking, clearing the queue."""
+        routes = list(self._pending)
+        self._pending.clear()
+        self.wakeup.clear()
+        return routes
+
+class AsyncMqttClient:
+    """
+    Drives a paho client from an asyncio event loop.
+
+    paho's socket callbacks register its socket with the loop, so reads, writes and
+    callbacks all run on the loop thread. No paho network thread is started.
+    """
+
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.disconnected = asyncio.Event()
+        self._misc = None
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    def _on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        self._misc = self.loop.create_task(self._misc_loop())
+
+    def _on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        if self._misc is not None:
+            self._misc.cancel()
+        self.disconnected.set()
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def _misc_loop(self):
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(MISC_LOOP_INTERVAL)
+
+    def connect(self, host, port, keepalive=60):
+        """
+        Connects the wrapped client; socket events are then served by the loop.
+
+        If the broker cannot be reached, the connection is left to reconnect_forever().
+        """
+        self.client.connect_async(host, port, keepalive)
+        self.disconnected.clear()
+        try:
+            self.client.reconnect()
+        except OSError as e:
+            logging.error(f"Connecting to MQTT Broker {host}:{port} failed: {e}")
+            self.disconnected.set()
+
+    async def reconnect_forever(self):
+        """
+        Waits for the connection to drop and reconnects, backing off along backoff_delays().
+
+        on_connect resubscribes after every reconnect, as with loop_forever().
+        """
+        while True:
+            await self.disconnected.wait()
+            for delay in backoff_delays():
+                logging.error(f"Disconnected from MQTT Broker, reconnecting in {delay:.1f} s")
+                await asyncio.sleep(delay)
+                self.disconnected.clear()
+                try:
+                    self.client.reconnect()
+                    break
+                except OSError as e:
+                    self.disconnected.set()
+                    logging.error(f"Reconnect failed: {e}")
+
+async def publisher(router, client, scheduler):
+    """
+    Publisher task: collects dirty routes and publishes their state as it becomes due.
+
+    Mirrors worker_thread, but waits on an asyncio.Event and publishes from the loop thread.
+    """
+    metrics = router.metrics
+    store = router.state_store
+    tracker = router.rpc_tracker
+    event_ns = {}
+    next_stats = time.monotonic() + SCHEDULER_STATS_INTERVAL
+    last_stats = None
+    was_online = False
+    while True:
+        online = router.online
+        if online and not was_online and len(scheduler):
+            logging.warning(f"Connected, sending the latest state of {len(scheduler)} dimmers held while offline")
+        was_online = online
+        deadline = earliest(scheduler.next_deadline() if online else None, next_stats,
+                            store.next_deadline() if store is not None else None,
+                            tracker.next_deadline() if tracker is not None and online else None)
+        if not router.wakeup.is_set():
+            timeout = max(0.0, deadline - time.monotonic())
+            try:
+                await asyncio.wait_for(router.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        for route in router.take_dirty():
+            state = route.parser.report_state()
+            targets = route.targets(state)
+            for topic, target in targets:
+                scheduler.submit(topic, target)
+            if store is not None:
+                store.update(route.knob, state["brightness"], state["output"])
+            if metrics is not None:
+                metrics.observe("worker_wakeup", route.event_ns)
+                for topic, _ in targets:
+                    event_ns[topic] = route.event_ns
+        now = time.monotonic()
+        if store is not None:
+            store.flush_due(now)
+        if router.online:
+            if tracker is not None:
+                retry_expired(tracker, scheduler, now)
+            release_due(router, client, scheduler, now, event_ns)
+        if now >= next_stats:
+            last_stats = report_scheduler_stats(scheduler, last_stats)
+            next_stats = now + SCHEDULER_STATS_INTERVAL
+
+async def watch_config(watcher, router, client, scheduler):
+    """Config task: applies changes to the config file on the loop thread, between messages."""
+    while True:
+        await asyncio.sleep(max(0.0, watcher.next_deadline() - time.monotonic()))
+        reload_config(watcher, router, client, scheduler)
+
+async def run(device_map, args, broker=MQTT_BROKER, port=MQTT_PORT, watcher=None):
+    """
+    Runs the controller on a single event loop, reconnecting whenever the broker
+    connection drops.
+
+    :param device_map: Iterable of knob -> dimmer mapping entries.
+    :param args: Parsed command line arguments of smart_knob_mqtt.main().
+    :param broker: MQTT broker host.
+    :param port: MQTT broker port.
+    :param watcher: Optional config_watcher.ConfigWatcher whose changes are applied while running.
+    :return: None
+    """
+    loop = asyncio.get_running_loop()
+    scheduler = PublishScheduler(args.max_rate)
+    tracker = RpcTracker()
+    router = AsyncKnobRouter(device_map, metrics=setup_metrics(args, scheduler, tracker),
+                             state_store=open_state_store(args), device_states=open_device_states(args),
+                             rpc_tracker=tracker)
+    router.configure_scheduler(scheduler)
+
+    client = mqtt.Client(userdata=router)
+    client.on_connect = on_connect
+    client.on_disconnect = on_disconnect
+    client.on_message = on_message
+    client.on_publish = on_publish
+    connection = AsyncMqttClient(loop, client)
+    connection.connect(broker, port, 60)
+
+    tasks = [asyncio.create_task(publisher(router, client, scheduler))]
+    if watcher is not None:
+        tasks.append(asyncio.create_task(watch_config(watcher, router, client, scheduler)))
+    try:
+        await connection.reconnect_forever()
+    finally:
+        for task in tasks:
+            task.cancel()
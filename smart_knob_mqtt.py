@@ -1,74 +1,179 @@
+import argparse
+import atexit
 import json
 import paho.mqtt.client as mqtt
 import logging
 import os
+import random
+import signal
+import sys
 import threading
 import time
+try:
+    import orjson
+except ImportError:  # Optional faster JSON backend
+    orjson = None
+from config_watcher import ConfigWatcher
+from dedup_cache import DedupCache
+from device_state import DeviceStateCache
+from fade_engine import FadeEngine, FADE_DEVICE, FADE_MODES
+from knob_logging import LineRotatingFileHandler, start_queue_logging
+from knob_metrics import Metrics, OTHER_ACTION, start_http_server, start_stats_dumper
+from publish_scheduler import PublishScheduler, MAX_COMMANDS_PER_SECOND
+from rpc_tracker import RpcTracker, next_request_id
+from state_store import StateStore
 
 # MQTT Connection
 MQTT_BROKER = "publicweb.local"  # Change this to your MQTT broker address
 MQTT_PORT = 1883  # Default MQTT port
-MQTT_TOPIC = "zigbee2mqtt/Smart_Knob_1"
+Z2M_BASE_TOPIC = "zigbee2mqtt"
+MQTT_TOPIC = f"{Z2M_BASE_TOPIC}/+"  # Wildcard subscription covering every knob
+RPC_SRC = "timtw"  # Source name of our RPC requests; Shelly replies on <RPC_SRC>/rpc
+RPC_REPLY_TOPIC = f"{RPC_SRC}/rpc"
+RPC_QOS = 1  # Light.Set is published at least once; the RPC response confirms it reached the dimmer
+RECONNECT_DELAY_MIN = 1  # Seconds before the first reconnect attempt, doubled per failure
+RECONNECT_DELAY_MAX = 120  # Same bound as paho's loop_forever() reconnects
+NETWORK_LOOP_TIMEOUT = 1.0  # Seconds client.loop() blocks waiting for traffic
+DEVICE_STATE_HOLDOFF = 2.0  # Seconds after a knob change during which dimmer status events are not applied
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
-logger = logging.getLogger()
+# Knob -> dimmer mapping
+DEVICE_MAP_PATH = 'knob_map.json'
+DEFAULT_DEVICE_MAP = [{"knob": "Smart_Knob_1", "dimmer": "shellyplus010v"}]
+STATE_FILE_PATH = 'smart_knob_state.jsonl'  # Last state per knob, restored at startup
 
-# Remove default handler to avoid duplicate log entries
-if logger.hasHandlers():
-    logger.handlers.clear()
-
-# Create handlers
-console_handler = logging.StreamHandler()
-file_handler = logging.FileHandler('smart_knob_mqtt.log')
-
-# Set level for handlers
-console_handler.setLevel(logging.ERROR)
-file_handler.setLevel(logging.WARNING)
-
-# Create formatter and add it to the handlers
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-console_handler.setFormatter(formatter)
-file_handler.setFormatter(formatter)
-
-# Add handlers to the logger
-logger.addHandler(console_handler)
-logger.addHandler(file_handler)
+# JSON decoding straight from msg.payload bytes
+json_loads = orjson.loads if orjson is not None else json.loads
 
 # Constants
+OPERATION_MODES = ("command", "event")
 DEFAULT_ACTION_STEP_SIZE = 10
 STEP_SIZE_DIVISOR = 5
 MAX_BRIGHTNESS = 100
 MIN_BRIGHTNESS = 36
 START_BRIGHTNESS = 66
+DEFAULT_BRIGHTNESS_LIMITS = {"min": MIN_BRIGHTNESS, "max": MAX_BRIGHTNESS, "start": START_BRIGHTNESS}
+ACCELERATION_WINDOW = 0.8  # Seconds between same-direction steps below which steps are scaled up
+ACCELERATION_MAX_FACTOR = 4.0  # Step multiplier for back-to-back steps
+ACCELERATION_EXPONENT = 1.0  # Curve shape; higher keeps moderate spins closer to 1x
 LOG_FILE_PATH = 'smart_knob_mqtt.log'
-MAX_LOG_LINES = 1000
-TRUNCATE_INTERVAL = 1000
+CONSOLE_LOG_LEVEL = logging.ERROR
+FILE_LOG_LEVEL = logging.WARNING
+SCHEDULER_STATS_INTERVAL = 60  # Seconds between publish scheduler counter reports
+SCHEDULER_STATS_LOG_LEVEL = FILE_LOG_LEVEL  # Level the counters are logged at, so they reach the log file
+MAX_LOG_LINES = 1000  # Lines kept across the log file and its rotated backup
+LOG_BACKUP_COUNT = 1
 LOCK_TIMEOUT = 2  # Timeout in seconds for acquiring the lock
 
-# Message counter
-message_counter = 0
+# Level checks for the message path, cached by refresh_log_levels() so that disabled
+# debug/info calls cost one global lookup instead of a logging call
+log_debug = False
+log_info = False
 
-def truncate_log_file():
-    """Truncates the log file if it exceeds a certain number of lines."""
-    try:
-        with open(LOG_FILE_PATH, 'r') as file:
-            lines = file.readlines()
-        if len(lines) > MAX_LOG_LINES:
-            with open(LOG_FILE_PATH, 'w') as file:
-                file.writelines(lines[-MAX_LOG_LINES:])
-            logging.info(f"Truncated log file to the last {MAX_LOG_LINES} lines.")
-    except Exception as e:
-        logging.error(f"Error truncating log file: {e}")
+def refresh_log_levels():
+    """Re-reads the root logger level into the cached log_debug/log_info flags."""
+    global log_debug, log_info
+    logger = logging.getLogger()
+    log_debug = logger.isEnabledFor(logging.DEBUG)
+    log_info = logger.isEnabledFor(logging.INFO)
+
+def setup_logging():
+    """
+    Configures the console and file log handlers.
+
+    The root logger level follows the most verbose handler, so records nobody would write
+    are never created. The handlers run behind a queue listener thread, which also does
+    the formatting, so logging never blocks on_message.
+    """
+    logger = logging.getLogger()
+    logger.setLevel(min(CONSOLE_LOG_LEVEL, FILE_LOG_LEVEL))
+
+    # Remove default handler to avoid duplicate log entries
+    if logger.hasHandlers():
+        logger.handlers.clear()
+
+    # Create handlers
+    console_handler = logging.StreamHandler()
+    file_handler = LineRotatingFileHandler(LOG_FILE_PATH, MAX_LOG_LINES, LOG_BACKUP_COUNT)
+
+    # Set level for handlers
+    console_handler.setLevel(CONSOLE_LOG_LEVEL)
+    file_handler.setLevel(FILE_LOG_LEVEL)
+
+    # Create formatter and add it to the handlers
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    console_handler.setFormatter(formatter)
+    file_handler.setFormatter(formatter)
+
+    refresh_log_levels()
+
+    # Hand the handlers to a background listener fed through a queue
+    return start_queue_logging(logger, [console_handler, file_handler])
+
+class AccelerationCurve:
+    """
+    Maps the time between two same-direction knob steps to a step multiplier.
+
+    Steps further apart than window are applied as they are. Closer steps are scaled
+    up along (1 - interval / window) ** exponent, reaching max_factor for back-to-back
+    steps, so a fast spin covers the range in a few events while a slow turn stays
+    fine-grained.
+    """
+
+    __slots__ = ("window", "max_factor", "exponent")
+
+    def __init__(self, window=ACCELERATION_WINDOW, max_factor=ACCELERATION_MAX_FACTOR,
+                 exponent=ACCELERATION_EXPONENT):
+        if not all(isinstance(value, (int, float)) for value in (window, max_factor, exponent)) \
+                or window <= 0 or max_factor < 1 or exponent <= 0:
+            raise ValueError(f"Acceleration curve out of range: window={window!r}, max_factor={max_factor!r}, "
+                             f"exponent={exponent!r}")
+        self.window = window
+        self.max_factor = max_factor
+        self.exponent = exponent
+
+    def factor(self, interval):
+        """Returns the step multiplier for a step interval seconds after the previous one."""
+        if interval >= self.window:
+            return 1.0
+        return 1.0 + (self.max_factor - 1.0) * (1.0 - interval / self.window) ** self.exponent
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Builds a curve from a device map "acceleration" entry.
+
+        :param config: True for the default curve, False or None to disable acceleration,
+                       or a dict of window/max_factor/exponent overrides.
+        :return: An AccelerationCurve, or None.
+        """
+        if not config:
+            return None
+        if config is True:
+            return cls()
+        return cls(**config)
+
+    def __repr__(self):
+        return f"AccelerationCurve(window={self.window}, max_factor={self.max_factor}, exponent={self.exponent})"
 
 class SmartKnobParser:
-    def __init__(self):
-        """Initializes the SmartKnobParser."""
+    def __init__(self, on_dirty=None, acceleration=None, clock=time.monotonic):
+        """
+        Initializes the SmartKnobParser.
+
+        :param on_dirty: Optional callable invoked with the parser whenever its state is marked dirty.
+        :param acceleration: Optional AccelerationCurve applied to rotation and brightness steps.
+        :param clock: Monotonic clock returning seconds, used to time the steps.
+        """
         logging.debug("SmartKnobParser initialized")
         self._brightness = 0
         self._output = False
         self._dirty = False
         self._lock = threading.Condition()
+        self._on_dirty = on_dirty
+        self._acceleration = acceleration
+        self._clock = clock
+        self._last_step_direction = 0
+        self._last_step_at = 0.0
 
     @property
     def brightness(self):
@@ -89,10 +194,13 @@ class SmartKnobParser:
             try:
                 self._brightness = value
                 self._dirty = True  # Set _dirty directly to avoid deadlock
-                logging.debug(f"Brightness set to {value}, dirty flag set to True")
+                if log_debug:
+                    logging.debug("Brightness set to %s, dirty flag set to True", value)
                 self._lock.notify()  # Notify the worker thread
             finally:
                 self._lock.release()
+            if self._on_dirty is not None:
+                self._on_dirty(self)
         else:
             logging.error("Failed to acquire lock for setting brightness")
             raise TimeoutError("Failed to acquire lock for setting brightness")
@@ -117,9 +225,12 @@ class SmartKnobParser:
                 self._output = value
                 self._dirty = True  # Set _dirty directly to avoid deadlock
                 self._lock.notify()  # Notify the worker thread
-                logging.debug(f"Output set to {value}, dirty flag set to True")
+                if log_debug:
+                    logging.debug("Output set to %s, dirty flag set to True", value)
             finally:
                 self._lock.release()
+            if self._on_dirty is not None:
+                self._on_dirty(self)
         else:
             logging.error("Failed to acquire lock for setting output")
             raise TimeoutError("Failed to acquire lock for setting output")
@@ -142,120 +253,181 @@ class SmartKnobParser:
         if self._lock.acquire(timeout=LOCK_TIMEOUT):
             try:
                 self._dirty = value
-                logging.debug(f"Dirty flag set to {value}")
+                if log_debug:
+                    logging.debug("Dirty flag set to %s", value)
             finally:
                 self._lock.release()
         else:
             logging.error("Failed to acquire lock for setting dirty")
             raise TimeoutError("Failed to acquire lock for setting dirty")
 
-    def parse_message(self, topic: str, payload: str):
+    def restore_state(self, brightness, output):
+        """Sets the brightness and output without marking the state dirty, e.g. after a restart."""
+        if self._lock.acquire(timeout=LOCK_TIMEOUT):
+            try:
+                self._brightness = brightness
+                self._output = output
+            finally:
+                self._lock.release()
+        else:
+            logging.error("Failed to acquire lock for restoring state")
+            raise TimeoutError("Failed to acquire lock for restoring state")
+
+    actions = {}  # (operation_mode, action) -> handler(parser, data), filled in below the class
+
+    @classmethod
+    def register_action(cls, operation_mode, action, handler):
+        """
+        Registers a handler for an (operation_mode, action) pair, replacing any existing one.
+
+        The table is shared by every parser, so plugins can add actions such as
+        color_temperature_step_* or double without touching the parser.
+
+        :param operation_mode: "command" or "event".
+        :param action: The zigbee2mqtt action name.
+        :param handler: Callable taking (parser, data).
+        :return: None
+        """
+        cls.actions[(operation_mode, action)] = handler
+
+    def parse_message(self, topic: str, payload):
         """
         Parses an MQTT message, extracts its fields, and processes it accordingly.
         
         :param topic: The MQTT topic (not used in logic but included for completeness).
-        :param payload: The JSON-formatted payload string.
+        :param payload: The JSON-formatted payload, as bytes or str.
         :return: None
         """
-        logging.debug(f"Parsing message from topic: {topic} with payload: {payload}")
+        if log_debug:
+            logging.debug("Parsing message from topic: %s with payload: %s", topic, payload)
+        data = self.decode_payload(payload)
+        if data is not None:
+            self.handle_data(data)
+
+    @staticmethod
+    def decode_payload(payload):
+        """
+        Decodes a JSON payload, using orjson when it is installed.
+
+        :param payload: The JSON-formatted payload, as bytes (msg.payload) or str.
+        :return: The decoded dict, or None if the payload is not a valid JSON object.
+        """
         try:
-            data = json.loads(payload)
-        except json.JSONDecodeError:
+            data = json_loads(payload)
+        except ValueError:
             logging.error("Invalid JSON payload")
-            return
-
-        operation_mode = data.get("operation_mode")
-        action = data.get("action")
+            return None
+        if not isinstance(data, dict):
+            logging.error("JSON payload is not an object")
+            return None
+        return data
 
-        if operation_mode == "command":
-            self.handle_command(action, data)
-        elif operation_mode == "event":
-            self.handle_event(action, data)
-        else:
-            logging.error(f"Unknown operation mode: {operation_mode}")
+    @classmethod
+    def find_handler(cls, operation_mode, action):
+        """Returns the handler registered for (operation_mode, action), or None."""
+        try:
+            return cls.actions.get((operation_mode, action))
+        except TypeError:  # A list or object in the payload cannot be a table key
+            return None
 
-    def handle_command(self, action, data):
+    def handle_data(self, data):
         """
-        Handles 'command' operation mode actions.
-        
-        :param action: The action to be performed.
-        :param data: The data associated with the action.
+        Processes a decoded knob message through the (operation_mode, action) table.
+
+        Only the handler reads further fields, so battery, linkquality and the like are
+        never touched.
+
+        :param data: The decoded payload.
         :return: None
         """
-        logging.debug(f"Handling command action: {action}")
-        if action == "brightness_step_up":
-            self.brightness_step_up(data)
-        elif action == "brightness_step_down":
-            self.brightness_step_down(data)
-        elif action == "color_temperature_step_up":
-            self.color_temperature_step_up(data)
-        elif action == "color_temperature_step_down":
-            self.color_temperature_step_down(data)
-        elif action == "toggle":
-            self.toggle(data)
+        operation_mode = data.get("operation_mode")
+        action = data.get("action")
+        handler = self.find_handler(operation_mode, action)
+        if handler is not None:
+            if log_debug:
+                logging.debug("Handling %s action: %s", operation_mode, action)
+            handler(self, data)
+        elif operation_mode in OPERATION_MODES:
+            logging.error("Unhandled %s action: %s", operation_mode, action)
         else:
-            logging.error(f"Unhandled command action: {action}")
+            logging.error("Unknown operation mode: %s", operation_mode)
 
-    def handle_event(self, action, data):
+    def accelerate(self, step, direction):
         """
-        Handles 'event' operation mode actions.
-        
-        :param action: The action to be performed.
-        :param data: The data associated with the action.
-        :return: None
+        Scales a brightness step by the acceleration curve.
+
+        :param step: The unscaled step size.
+        :param direction: 1 for up, -1 for down; a change of direction resets the curve.
+        :return: The step to apply.
         """
-        logging.debug(f"Handling event action: {action}")
-        if action == "rotate_left":
-            self.rotate_left(data)
-        elif action == "rotate_right":
-            self.rotate_right(data)
-        elif action == "double":
-            self.double_press(data)
-        elif action == "single":
-            self.single_press(data)
-        else:
-            logging.error(f"Unhandled event action: {action}")
+        if self._acceleration is None:
+            return step
+        now = self._clock()
+        if direction == self._last_step_direction:
+            step = round(step * self._acceleration.factor(now - self._last_step_at))
+        self._last_step_direction = direction
+        self._last_step_at = now
+        return step
+
+    def set_brightness(self, brightness):
+        """Sets the brightness unless it is unchanged, e.g. at a limit, so no publish is queued."""
+        if brightness != self._brightness:
+            self.brightness = brightness
 
     def brightness_step_up(self, data):
         """Increases brightness by the specified step size."""
-        step_size = data.get('action_step_size', 0)
-        self.brightness = min(MAX_BRIGHTNESS, self.brightness + int(step_size/STEP_SIZE_DIVISOR))
-        logging.info(f"Increasing brightness by {step_size}. New brightness: {self.brightness}")
+        step_size = self.accelerate(data.get('action_step_size', 0), 1)
+        brightness = min(MAX_BRIGHTNESS, self.brightness + int(step_size/STEP_SIZE_DIVISOR))
+        self.set_brightness(brightness)
+        if log_info:
+            logging.info("Increasing brightness by %s. New brightness: %s", step_size, brightness)
 
     def brightness_step_down(self, data):
         """Decreases brightness by the specified step size."""
-        step_size = data.get('action_step_size', 0)
-        self.brightness = max(MIN_BRIGHTNESS, self.brightness - int(step_size/STEP_SIZE_DIVISOR))
-        logging.info(f"Decreasing brightness by {step_size}. New brightness: {self.brightness}")
+        step_size = self.accelerate(data.get('action_step_size', 0), -1)
+        brightness = max(MIN_BRIGHTNESS, self.brightness - int(step_size/STEP_SIZE_DIVISOR))
+        self.set_brightness(brightness)
+        if log_info:
+            logging.info("Decreasing brightness by %s. New brightness: %s", step_size, brightness)
 
     def color_temperature_step_up(self, data):
         """Increases color temperature by the specified step size."""
-        logging.info(f"Increasing color temperature by {data.get('action_step_size', 0)}")
+        if log_info:
+            logging.info("Increasing color temperature by %s", data.get('action_step_size', 0))
 
     def color_temperature_step_down(self, data):
         """Decreases color temperature by the specified step size."""
-        logging.info(f"Decreasing color temperature by {data.get('action_step_size', 0)}")
+        if log_info:
+            logging.info("Decreasing color temperature by %s", data.get('action_step_size', 0))
 
     def toggle(self, data):
         """Toggles the state."""
-        self.output = not self.output  # This calls the output setter
-        if self.output:
-            if self.brightness < START_BRIGHTNESS:
-                self.brightness = START_BRIGHTNESS
-        
-        logging.info(f"Toggling state. New output: {self.output} brightness: {self.brightness}")
+        output = not self.output
+        self.output = output  # This calls the output setter
+        brightness = self.brightness
+        if output:
+            if brightness < START_BRIGHTNESS:
+                brightness = START_BRIGHTNESS
+                self.brightness = brightness
+
+        if log_info:
+            logging.info("Toggling state. New output: %s brightness: %s", output, brightness)
 
     def rotate_left(self, data):
         """Handles the rotate left action."""
-        step_size = data.get('action_step_size', DEFAULT_ACTION_STEP_SIZE)
-        self.brightness = max(MIN_BRIGHTNESS, self.brightness - step_size)
-        logging.info(f"Knob rotated left by {step_size}. New brightness: {self.brightness}")
+        step_size = self.accelerate(data.get('action_step_size', DEFAULT_ACTION_STEP_SIZE), -1)
+        brightness = max(MIN_BRIGHTNESS, self.brightness - step_size)
+        self.set_brightness(brightness)
+        if log_info:
+            logging.info("Knob rotated left by %s. New brightness: %s", step_size, brightness)
 
     def rotate_right(self, data):
         """Handles the rotate right action."""
-        step_size = data.get('action_step_size', DEFAULT_ACTION_STEP_SIZE)
-        self.brightness = min(MAX_BRIGHTNESS, self.brightness + step_size)
-        logging.info(f"Knob rotated right by {step_size}. New brightness: {self.brightness}")
+        step_size = self.accelerate(data.get('action_step_size', DEFAULT_ACTION_STEP_SIZE), 1)
+        brightness = min(MAX_BRIGHTNESS, self.brightness + step_size)
+        self.set_brightness(brightness)
+        if log_info:
+            logging.info("Knob rotated right by %s. New brightness: %s", step_size, brightness)
 
     def double_press(self, data):
         """Handles the double press action."""
@@ -263,8 +435,10 @@ class SmartKnobParser:
 
     def single_press(self, data):
         """Handles the single press action."""
-        self.output = not self.output  # This calls the output setter
-        logging.info(f"Single press detected. New output: {self.output}")
+        output = not self.output
+        self.output = output  # This calls the output setter
+        if log_info:
+            logging.info("Single press detected. New output: %s", output)
 
     def report_state(self):
         """Reports the current brightness and output state and clears the dirty flag."""
@@ -275,90 +449,924 @@ class SmartKnobParser:
                     "output": self._output
                 }
                 self.dirty = False
-                logging.debug("Dirty flag cleared")
+                if log_debug:
+                    logging.debug("Dirty flag cleared")
             finally:
                 self._lock.release()
-            logging.info(f"Reporting state: {state}")
+            if log_info:
+                logging.info("Reporting state: %s", state)
             return state
         else:
             logging.error("Failed to acquire lock for reporting state")
             raise TimeoutError("Failed to acquire lock for reporting state")
 
-def worker_thread(parser):
-    """Worker thread function that waits for the condition variable and reports the state if dirty."""
-    topic = 'shellyplus010v/rpc'
+SmartKnobParser.actions.update({
+    ("command", "brightness_step_up"): SmartKnobParser.brightness_step_up,
+    ("command", "brightness_step_down"): SmartKnobParser.brightness_step_down,
+    ("command", "color_temperature_step_up"): SmartKnobParser.color_temperature_step_up,
+    ("command", "color_temperature_step_down"): SmartKnobParser.color_temperature_step_down,
+    ("command", "toggle"): SmartKnobParser.toggle,
+    ("event", "rotate_left"): SmartKnobParser.rotate_left,
+    ("event", "rotate_right"): SmartKnobParser.rotate_right,
+    ("event", "double"): SmartKnobParser.double_press,
+    ("event", "single"): SmartKnobParser.single_press,
+})
+
+class GroupMember:
+    """
+    One dimmer driven by a knob, with its own brightness curve.
+
+    The knob range MIN_BRIGHTNESS..MAX_BRIGHTNESS is mapped linearly onto min..max, then
+    offset is added and the result is clamped to 0..100. The defaults pass the knob
+    brightness through unchanged; min and max default to the knob range in effect when
+    the member is created.
+    """
+
+    __slots__ = ("dimmer", "rpc_topic", "offset", "min", "max", "scale")
+
+    def __init__(self, dimmer, offset=0, min=None, max=None):
+        self.dimmer = dimmer
+        self.rpc_topic = f"{dimmer}/rpc"
+        self.offset = offset
+        self.min = MIN_BRIGHTNESS if min is None else min
+        self.max = MAX_BRIGHTNESS if max is None else max
+        self.scale = (self.max - self.min) / (MAX_BRIGHTNESS - MIN_BRIGHTNESS)
+
+    @classmethod
+    def from_config(cls, config):
+        """Builds a member from a dimmer id or a {"dimmer": ..., "offset": ..., "min": ..., "max": ...} entry."""
+        if isinstance(config, str):
+            return cls(config)
+        return cls(**config)
+
+    @property
+    def identity(self):
+        """True if the member gets the knob brightness unchanged."""
+        return self.offset == 0 and self.min == MIN_BRIGHTNESS and self.max == MAX_BRIGHTNESS
+
+    def __repr__(self):
+        return f"GroupMember({self.dimmer}, offset={self.offset}, min={self.min}, max={self.max})"
+
+class Route:
+    """
+    A knob -> dimmer pairing together with the parser that holds the knob's state.
+
+    A knob may drive a group of dimmers. Every member target is computed from the one
+    knob state in a single pass, and all of them are queued together, so the whole
+    group is published in the same worker pass.
+    """
+
+    __slots__ = ("knob", "dimmer", "knob_topic", "rpc_topic", "members", "max_rate", "fade", "transition",
+                 "parser", "event_ns", "changed_at", "_curves")
+
+    def __init__(self, knob, dimmer, base_topic=Z2M_BASE_TOPIC, max_rate=None, fade=FADE_DEVICE,
+                 transition=None):
+        """
+        Initializes the Route.
+
+        :param knob: The zigbee2mqtt friendly name of the knob.
+        :param dimmer: A Shelly device id, or a list of GroupMember.from_config() entries for a group.
+        :param max_rate: Commands per second to each member, or None for the --max-rate cap.
+        :param fade: One of FADE_MODES.
+        :param transition: Seconds each device-side ramp lasts, and so the interval between
+                           commands, or None for one --max-rate interval.
+        :raises ValueError: On an unknown fade mode, or a max_rate or transition that is not positive.
+        """
+        if fade not in FADE_MODES:
+            raise ValueError(f"Unknown fade mode {fade!r} for {knob}, expected one of {FADE_MODES}")
+        for name, value in (("max_rate", max_rate), ("transition", transition)):
+            if value is not None and not (isinstance(value, (int, float)) and value > 0):
+                raise ValueError(f"{name} of {knob} must be a positive number, got {value!r}")
+        self.members = [GroupMember.from_config(member)
+                        for member in (dimmer if isinstance(dimmer, list) else [dimmer])]
+        self.knob = knob
+        self.dimmer = self.members[0].dimmer
+        self.knob_topic = f"{base_topic}/{knob}"
+        self.rpc_topic = self.members[0].rpc_topic
+        # None when the single member passes the state through unchanged
+        self._curves = None if len(self.members) == 1 and self.members[0].identity else [
+            (member.rpc_topic, member.min - MIN_BRIGHTNESS * member.scale + member.offset, member.scale)
+            for member in self.members]
+        self.max_rate = max_rate
+        self.fade = fade
+        self.transition = transition
+        self.parser = None
+        self.event_ns = 0  # perf_counter_ns() of the last message received, when metrics are enabled
+        self.changed_at = None  # time.monotonic() of the last knob-driven state change
+
+    @classmethod
+    def from_config(cls, entry):
+        """Builds the route of a mapping entry, validating it; the parser is left unset."""
+        return cls(entry["knob"], entry.get("dimmers") or entry["dimmer"], entry.get("base_topic", Z2M_BASE_TOPIC),
+                   entry.get("max_rate"), entry.get("fade", FADE_DEVICE), entry.get("transition"))
+
+    @property
+    def direct(self):
+        """True if the route drives one dimmer with the knob state unchanged."""
+        return self._curves is None
+
+    def targets(self, state):
+        """
+        Computes the state to send to every member for a knob state.
+
+        :param state: The knob state from report_state().
+        :return: List of (rpc_topic, state) for every member.
+        """
+        if self._curves is None:
+            return [(self.rpc_topic, state)]
+        brightness = state["brightness"]
+        output = state["output"]
+        return [(topic, {"brightness": min(100, max(0, round(base + brightness * scale))), "output": output})
+                for topic, base, scale in self._curves]
+
+    def __repr__(self):
+        return f"Route({self.knob_topic} -> {', '.join(member.rpc_topic for member in self.members)})"
+
+class KnobRouter:
+    """
+    Routes knob messages for any number of knob/dimmer pairs over a single connection.
+
+    Incoming topics are looked up in a dict index, so dispatch costs the same for one knob
+    or several hundred. Parsers report state changes back to the router, which queues the
+    dirty routes for a single worker thread to publish.
+
+    With a DeviceStateCache, the router also follows the dimmers' own status, so knob
+    math starts from the brightness the dimmer really has.
+
+    apply_config() swaps in a new mapping table while the controller runs. Only routes
+    whose entry changed are rebuilt, and they keep their knob state.
+
+    Knobs are subscribed through one base_topic/+ wildcard. With wildcard_topics set to
+    False every knob topic is subscribed on its own instead, so the broker delivers only
+    the routed knobs, as each shard of the sharded mode needs.
+    """
+
+    def __init__(self, device_map, parser_factory=SmartKnobParser, metrics=None, state_store=None,
+                 device_states=None, clock=time.monotonic, rpc_tracker=None):
+        """
+        Initializes the KnobRouter.
+
+        :param device_map: Iterable of {"knob": ..., "dimmer": ...} mapping entries; "dimmers" lists a group.
+        :param parser_factory: Callable accepting on_dirty= that creates the per-knob state object.
+        :param metrics: Optional knob_metrics.Metrics to record stage latencies into.
+        :param state_store: Optional state_store.StateStore the parsers are restored from.
+        :param device_states: Optional device_state.DeviceStateCache fed from the dimmers' status.
+        :param clock: Monotonic clock handed to the parsers for step acceleration.
+        :param rpc_tracker: Optional rpc_tracker.RpcTracker completed by the Light.Set responses.
+        """
+        self.metrics = metrics
+        self.state_store = state_store
+        self.device_states = device_states
+        self.rpc_tracker = rpc_tracker
+        self.clock = clock
+        self.online = False  # Whether the broker connection is up; states are held back while it is not
+        self.fades = FadeEngine()
+        self.dedup = DedupCache()
+        if metrics is not None:
+            metrics.add_collector("dedup", self.dedup.stats)
+        self.routes = {}
+        self.dimmers = {}  # dimmer -> routes driving it
+        self.parser_factory = parser_factory
+        self.wildcard_topics = True  # Subscribe to base_topic/+ rather than one topic per knob
+        self._entries = {}  # knob topic -> the mapping entry its route was built from
+        self._cond = threading.Condition()
+        self._pending = {}  # Insertion-ordered set of dirty routes
+        for entry in device_map:
+            route = self._build_route(entry)
+            if route.knob_topic in self.routes:
+                logging.warning(f"Duplicate mapping for {route.knob_topic}, replacing it")
+            self._install_route(route)
+            self._entries[route.knob_topic] = entry
+        logging.info(f"KnobRouter initialized with {len(self.routes)} routes")
+
+    def add_route(self, knob, dimmer, base_topic=Z2M_BASE_TOPIC, max_rate=None, parser_factory=None,
+                  acceleration=True, fade=FADE_DEVICE, transition=None):
+        """
+        Adds a knob -> dimmer route and returns it.
+
+        :param dimmer: A Shelly device id, or a list of group members as in GroupMember.from_config().
+        :param parser_factory: Overrides the router's parser factory for this route.
+        :param acceleration: As in AccelerationCurve.from_config().
+        """
+        entry = {"knob": knob, "dimmer": dimmer, "base_topic": base_topic, "max_rate": max_rate,
+                 "acceleration": acceleration, "fade": fade, "transition": transition}
+        route = self._build_route(entry, parser_factory)
+        self._install_route(route)
+        self._entries[route.knob_topic] = entry
+        return route
+
+    def _build_route(self, entry, parser_factory=None):
+        """Builds the route for a mapping entry without installing it."""
+        route = Route.from_config(entry)
+        route.parser = (parser_factory or self.parser_factory)(
+            on_dirty=lambda parser: self._mark_dirty(route),
+            acceleration=AccelerationCurve.from_config(entry.get("acceleration", True)), clock=self.clock)
+        saved = self.state_store.get(route.knob) if self.state_store is not None else None
+        if saved is not None:
+            route.parser.restore_state(*saved)
+        return route
+
+    def _install_route(self, route):
+        """Makes a route live, replacing any route on the same knob topic."""
+        if route.knob_topic in self.routes:
+            self._remove_route(route.knob_topic)
+        self.routes[route.knob_topic] = route
+        for member in route.members:
+            self.dimmers.setdefault(member.dimmer, []).append(route)
+
+    def _remove_route(self, knob_topic):
+        route = self.routes.pop(knob_topic)
+        for member in route.members:
+            routes = self.dimmers[member.dimmer]
+            routes.remove(route)
+            if not routes:
+                del self.dimmers[member.dimmer]
+        return route
+
+    def apply_config(self, device_map, client=None, scheduler=None, rebuild=False):
+        """
+        Brings the routes in line with a new mapping table, touching only what changed.
+
+        Routes whose entry is unchanged are kept as they are. Changed routes are rebuilt
+        and take over the knob state of the route they replace. Every new route is built,
+        and so validated, before any is installed: an entry that fails validation leaves
+        the current routes in place. Configs from load_config() are already validated.
+        Subscriptions and Light.GetStatus requests are sent for the difference only.
+
+        Must run on the thread that dispatches messages, so no message sees a
+        half-applied table.
+
+        :param device_map: The new mapping entries.
+        :param client: The MQTT client to update the subscriptions on, if connected.
+        :param scheduler: The PublishScheduler to apply the rate caps and fade modes to.
+        :param rebuild: Rebuild every route, e.g. after the brightness limits changed.
+        :return: (added, changed, removed) route counts.
+        """
+        entries = {f"{entry.get('base_topic', Z2M_BASE_TOPIC)}/{entry['knob']}": entry for entry in device_map}
+        built = [self._build_route(entry) for topic, entry in entries.items()
+                 if rebuild or self._entries.get(topic) != entry]
+        removed = [topic for topic in self._entries if topic not in entries]
+        old_subscriptions = set(self.subscriptions())
+        old_dimmers = set(self.dimmers)
+
+        for topic in removed:
+            self._remove_route(topic)
+        changed = 0
+        for route in built:
+            replaced = self.routes.get(route.knob_topic)
+            if replaced is not None:
+                route.parser.restore_state(replaced.parser.brightness, replaced.parser.output)
+                changed += 1
+            self._install_route(route)
+        self._entries = entries
+
+        if scheduler is not None:
+            self.configure_scheduler(scheduler)
+        if client is not None and self.online:
+            subscriptions = set(self.subscriptions())
+            if old_subscriptions - subscriptions:
+                client.unsubscribe(sorted(old_subscriptions - subscriptions))
+            if subscriptions - old_subscriptions:
+                client.subscribe([(topic, 0) for topic in sorted(subscriptions - old_subscriptions)])
+            self.request_device_status(client, set(self.dimmers) - old_dimmers)
+        return len(built) - changed, changed, len(removed)
+
+    def subscriptions(self):
+        """Returns the topics that cover every routed knob, plus the dimmer status topics."""
+        if self.wildcard_topics:
+            topics = sorted({route.knob_topic.rsplit('/', 1)[0] + '/+' for route in self.routes.values()})
+        else:
+            topics = sorted(self.routes)
+        if self.device_states is not None:
+            topics += self.device_states.subscriptions(self.dimmers)
+        elif self.rpc_tracker is not None:
+            topics.append(RPC_REPLY_TOPIC)
+        return topics
+
+    def request_device_status(self, client, dimmers=None):
+        """Publishes one Light.GetStatus request per dimmer, all dimmers by default, to seed the device state cache."""
+        if self.device_states is None:
+            return
+        if dimmers is None:
+            dimmers = self.dimmers
+        for dimmer in dimmers:
+            topic, payload = self.device_states.status_request(dimmer)
+            client.publish(topic, payload)
+        logging.info(f"Requested the status of {len(dimmers)} dimmers")
+
+    def dispatch(self, topic: str, payload, received_ns=None):
+        """
+        Hands a message to the parser of the knob publishing on the topic.
+
+        :param topic: The MQTT topic the message arrived on.
+        :param payload: The JSON-formatted payload, as bytes or str.
+        :param received_ns: perf_counter_ns() taken when the message arrived, used for metrics.
+        :return: True if the topic belongs to a routed knob, False otherwise.
+        """
+        route = self.routes.get(topic)
+        if route is None:
+            if topic == RPC_REPLY_TOPIC:
+                self.handle_rpc_reply(topic, payload)
+            elif self.device_states is not None and self.device_states.is_status_topic(topic):
+                self.handle_device_status(topic, payload)
+            return False
+        metrics = self.metrics
+        if metrics is None:
+            route.parser.parse_message(topic, payload)
+            return True
+
+        if received_ns is None:
+            received_ns = time.perf_counter_ns()
+        route.event_ns = received_ns
+        data = route.parser.decode_payload(payload)
+        metrics.observe("decode", received_ns)
+        if data is not None:
+            action = data.get("action")
+            if route.parser.find_handler(data.get("operation_mode"), action) is None:
+                action = OTHER_ACTION
+            metrics.count_action(action)
+            route.parser.handle_data(data)
+            metrics.observe("dispatch", received_ns)
+        return True
+
+    def handle_rpc_reply(self, topic, payload):
+        """Completes the tracked Light.Set a response belongs to, or passes it to the device state cache."""
+        data = SmartKnobParser.decode_payload(payload)
+        if not isinstance(data, dict):
+            return
+        if self.rpc_tracker is not None:
+            key = self.rpc_tracker.acknowledge(data)
+            if key is not None:
+                self.dedup.acknowledge(key, data["id"], "error" not in data)
+                return
+        if self.device_states is not None:
+            self.sync_device_state(self.device_states.handle(topic, data))
+
+    def handle_device_status(self, topic, payload):
+        """Feeds a dimmer status event into the device state cache."""
+        self.sync_device_state(self.device_states.handle(topic, SmartKnobParser.decode_payload(payload)))
+
+    def sync_device_state(self, dimmer):
+        """
+        Copies the cached state of a dimmer into the parsers of the knobs driving it.
+
+        The parsers are not marked dirty. Knobs changed within DEVICE_STATE_HOLDOFF
+        seconds keep their own state, since the dimmer is still catching up with the
+        commands sent for it. Knobs driving a group or a curve are left alone, since
+        one member does not tell their state.
+
+        :param dimmer: The dimmer whose cached state changed, or None.
+        :return: None
+        """
+        if dimmer is None:
+            return
+        state = self.device_states.get(dimmer)
+        if state is None:
+            return
+        self.dedup.observe(f"{dimmer}/rpc", *state)
+        now = time.monotonic()
+        for route in self.dimmers.get(dimmer, ()):
+            if not route.direct:
+                continue
+            changed_at = self._changed_at(route)
+            if changed_at is not None and now - changed_at < DEVICE_STATE_HOLDOFF:
+                continue
+            route.parser.restore_state(*state)
+            if self.state_store is not None:
+                self.state_store.update(route.knob, *state)
+            if log_info:
+                logging.info("Synced %s from %s: brightness %s output %s", route.knob, dimmer, *state)
+
+    def set_online(self, online):
+        """Records whether the broker connection is up and wakes the worker thread."""
+        with self._cond:
+            self.online = online
+            self._cond.notify()
+
+    def _changed_at(self, route):
+        return route.changed_at
+
+    def _mark_dirty(self, route):
+        """Queues a route for publishing and wakes the worker thread."""
+        route.changed_at = time.monotonic()
+        if self.metrics is not None:
+            self.metrics.observe("state_change", route.event_ns)
+        with self._cond:
+            self._pending[route] = None
+            self._cond.notify()
+
+    def configure_scheduler(self, scheduler):
+        """
+        Applies per-dimmer rate caps and fade modes from the mapping table.
+
+        A dimmer is sent at most one command per scheduler interval, --max-rate unless
+        the mapping sets its own max_rate or, for a dimmer that ramps itself, its own
+        transition. Device-side ramps last the whole interval, so each one ends as the
+        next command arrives.
+        """
+        for route in self.routes.values():
+            max_rate = route.max_rate
+            if max_rate is None and route.fade == FADE_DEVICE and route.transition is not None:
+                max_rate = 1.0 / route.transition
+            for member in route.members:
+                scheduler.set_rate(member.rpc_topic, max_rate)
+                self.fades.configure(member.rpc_topic, route.fade, scheduler.interval(member.rpc_topic))
+
+    def take_dirty(self, timeout=None):
+        """
+        Waits for dirty routes and returns them, clearing the queue.
+
+        :param timeout: Maximum time in seconds to wait, or None to wait indefinitely.
+        :return: List of routes whose state changed since the last call.
+        """
+        with self._cond:
+            if not self._pending:
+                self._cond.wait(timeout)
+            routes = list(self._pending)
+            self._pending.clear()
+        return routes
+
+def load_config(path=DEVICE_MAP_PATH):
+    """
+    Loads the controller config: the knob -> dimmer mapping table and optional settings.
+
+    The file is JSON of the form
+    {"devices": [{"knob": "Smart_Knob_1", "dimmer": "shellyplus010v"}],
+     "brightness": {"min": 36, "max": 100, "start": 66},
+     "mqtt": {"host": "publicweb.local", "port": 1883}}
+    where "brightness" and "mqtt" are optional. Falls back to DEFAULT_DEVICE_MAP when the
+    file does not exist.
+
+    Every mapping entry and setting is validated here, so a config that loads can be
+    applied without errors.
+
+    :return: Dict with "devices", "brightness" and "mqtt", defaults filled in.
+    :raises ValueError: If the file is not valid JSON or an entry or setting is invalid;
+                        KeyError or TypeError for entries of the wrong shape.
+    """
+    try:
+        with open(path, 'r') as file:
+            config = json.load(file)
+    except FileNotFoundError:
+        logging.warning(f"Device map {path} not found, using the default mapping")
+        config = {"devices": DEFAULT_DEVICE_MAP}
+    devices = config["devices"]
+    if not isinstance(devices, list) or not all(isinstance(entry, dict) and "knob" in entry for entry in devices):
+        raise ValueError("\"devices\" must be a list of {\"knob\": ..., \"dimmer\": ...} entries")
+    for entry in devices:
+        # Build every route and curve once, so an invalid entry rejects the file before anything uses it
+        Route.from_config(entry)
+        AccelerationCurve.from_config(entry.get("acceleration", True))
+    limits = dict(DEFAULT_BRIGHTNESS_LIMITS, **config.get("brightness", {}))
+    if not 0 <= limits["min"] < limits["max"] <= 100 or not limits["min"] <= limits["start"] <= limits["max"]:
+        raise ValueError(f"Brightness limits out of range: {limits}")
+    mqtt_settings = dict({"host": MQTT_BROKER, "port": MQTT_PORT}, **config.get("mqtt", {}))
+    if not isinstance(mqtt_settings["host"], str) or not isinstance(mqtt_settings["port"], int) \
+            or not 0 < mqtt_settings["port"] < 65536:
+        raise ValueError(f"Invalid MQTT settings: {mqtt_settings}")
+    logging.info(f"Loaded {len(devices)} device mappings from {path}")
+    return {"devices": devices, "brightness": limits, "mqtt": mqtt_settings}
+
+def load_device_map(path=DEVICE_MAP_PATH):
+    """Loads the knob -> dimmer mapping table of a config file, as in load_config()."""
+    return load_config(path)["devices"]
+
+def apply_brightness_limits(limits):
+    """
+    Sets MIN_BRIGHTNESS, MAX_BRIGHTNESS and START_BRIGHTNESS from a config "brightness" entry.
+
+    The knob handlers read them on the message thread, so calling this from that thread
+    switches all three at once.
+
+    :return: True if any of them changed.
+    """
+    global MIN_BRIGHTNESS, MAX_BRIGHTNESS, START_BRIGHTNESS
+    limits = (limits["min"], limits["max"], limits["start"])
+    if limits == (MIN_BRIGHTNESS, MAX_BRIGHTNESS, START_BRIGHTNESS):
+        return False
+    MIN_BRIGHTNESS, MAX_BRIGHTNESS, START_BRIGHTNESS = limits
+    return True
+
+def set_rpc_source(src):
+    """
+    Sets the source name of our RPC requests, and with it the topic the responses arrive on.
+
+    Controllers sharing a broker need distinct names: request ids are only unique per
+    process, so each must receive the responses to its own requests only.
+    """
+    global RPC_SRC, RPC_REPLY_TOPIC
+    RPC_SRC = src
+    RPC_REPLY_TOPIC = f"{src}/rpc"
+
+def reload_config(watcher, router, client, scheduler, keepalive=60):
+    """
+    Applies the config file if it changed since the last call.
+
+    Mapping changes are applied to the router as a diff, without touching the
+    connection. A new broker address makes the client disconnect, and the network
+    loop reconnects to the new broker.
+
+    Must run on the thread that dispatches messages.
+
+    :param watcher: The ConfigWatcher of the config file.
+    :return: None
+    """
+    previous = watcher.config
+    config = watcher.poll()
+    if config is None:
+        return
+    rebuild = apply_brightness_limits(config["brightness"])
+    try:
+        added, changed, removed = router.apply_config(config["devices"], client, scheduler, rebuild)
+    except (ValueError, KeyError, TypeError) as e:
+        apply_brightness_limits(previous["brightness"])
+        watcher.config = previous
+        logging.error(f"Invalid mapping in {watcher.path}, keeping the current config: {e!r}")
+        return
+    logging.warning(f"Reloaded {watcher.path}: {added} routes added, {changed} changed, {removed} removed")
+    if config["mqtt"] != previous["mqtt"]:
+        host, port = config["mqtt"]["host"], config["mqtt"]["port"]
+        logging.warning(f"MQTT Broker changed to {host}:{port}, reconnecting")
+        client.connect_async(host, port, keepalive)
+        client.disconnect()
+
+def publish_state(client, topic, state, request_id=None, qos=RPC_QOS):
+    """
+    Publishes a Light.Set RPC carrying the given state to a Shelly device.
+
+    A "transition_duration" in the state is passed on, so the dimmer ramps to the
+    brightness over that many seconds. A state without "output" or "brightness" leaves
+    that field of the dimmer as it is.
+
+    :param request_id: The RPC id the response will carry; a fresh one is used if None.
+    :param qos: The MQTT QoS of the publish.
+    :return: The paho MQTTMessageInfo, or None if publishing raised.
+    """
+    if request_id is None:
+        request_id = next_request_id()
+    params = ''
+    if "output" in state:
+        params += f',"on":{str(state["output"]).lower()}'
+    if "brightness" in state:
+        params += f',"brightness":{state["brightness"]}'
+    transition = state.get("transition_duration")
+    if transition:
+        params += f',"transition_duration":{transition}'
+    payload = f'{{"id":{request_id}, "src":"{RPC_SRC}", "method":"Light.Set", "params":{{"id":0{params}}}}}'
+    # Publish the payload to the topic
+    if log_info:
+        logging.info("Publishing message: %s %s", topic, payload)
+    try:
+        result = client.publish(topic, payload, qos)
+        # Check if the publish was successful
+        if result.rc != mqtt.MQTT_ERR_SUCCESS:
+            logging.error("Failed to publish message: %s", result.rc)
+        return result
+    except Exception as e:
+        logging.error("An error occurred while publishing %s %s: %s", topic, payload, e)
+        return None
+
+def report_scheduler_stats(scheduler, last_stats):
+    """
+    Logs the publish scheduler counters at SCHEDULER_STATS_LOG_LEVEL if they changed.
+
+    :param scheduler: The PublishScheduler.
+    :param last_stats: The counters returned by the previous call, or None.
+    :return: The current counters.
+    """
+    stats = scheduler.stats()
+    if stats != last_stats:
+        logging.log(SCHEDULER_STATS_LOG_LEVEL, "Publish scheduler stats: %s", stats)
+    return stats
+
+def backoff_delays(minimum=RECONNECT_DELAY_MIN, maximum=RECONNECT_DELAY_MAX):
+    """
+    Yields reconnect delays that double from minimum up to maximum.
+
+    Each delay is drawn from the upper half of its step, so controllers restarted
+    together by a broker outage do not reconnect in lockstep.
+    """
+    delay = minimum
+    while True:
+        yield random.uniform(delay / 2, delay)
+        delay = min(delay * 2, maximum)
+
+def run_network_loop(client, router, host, port, keepalive=60, on_tick=None):
+    """
+    Runs the paho network loop on the calling thread, reconnecting whenever the
+    connection is lost or cannot be made.
+
+    Failed attempts back off along backoff_delays(); the backoff starts over once the
+    broker has accepted a connection. on_connect resubscribes on every connect.
+
+    :param on_tick: Optional callable run on this thread about every NETWORK_LOOP_TIMEOUT
+                    seconds and before every connection attempt, e.g. to reload the config.
+    :return: Does not return.
+    """
+    client.connect_async(host, port, keepalive)
+    delays = None
+    while True:
+        if on_tick is not None:
+            on_tick()
+        try:
+            client.reconnect()
+        except OSError as e:
+            delays = delays or backoff_delays()
+            delay = next(delays)
+            logging.error(f"Connecting to MQTT Broker {host}:{port} failed: {e}, retrying in {delay:.1f} s")
+            time.sleep(delay)
+            continue
+        while client.loop(NETWORK_LOOP_TIMEOUT) == mqtt.MQTT_ERR_SUCCESS:
+            if router.online:
+                delays = None
+            if on_tick is not None:
+                on_tick()
+        delays = delays or backoff_delays()
+        delay = next(delays)
+        logging.error(f"Connection to MQTT Broker lost, reconnecting in {delay:.1f} s")
+        time.sleep(delay)
+
+def earliest(*deadlines):
+    """Returns the earliest of the given deadlines, ignoring None, or None if there are none."""
+    return min((deadline for deadline in deadlines if deadline is not None), default=None)
+
+def retry_expired(tracker, scheduler, now):
+    """
+    Hands the unanswered Light.Set requests back to the scheduler.
+
+    A request is only retried if no newer state is waiting for the same dimmer, so
+    retries never overwrite a newer brightness.
+    """
+    for key, state in tracker.expired(now):
+        if key not in scheduler:
+            if log_info:
+                logging.info("Retrying Light.Set on %s: %s", key, state)
+            scheduler.submit(key, state, now)
+
+def release_due(router, client, scheduler, now, event_ns):
+    """
+    Publishes every state the scheduler releases, through the fade engine and RPC tracker.
+
+    Commands that would not change the dimmer's acknowledged state are dropped by the
+    DedupCache, and only the changed fields of the others are sent.
+
+    :param event_ns: Receive time of the newest knob event behind each queued publish, for metrics.
+    :return: None
+    """
+    metrics = router.metrics
+    tracker = router.rpc_tracker
+    dedup = router.dedup
+    for topic, state in scheduler.pop_due(now):
+        command = router.fades.plan(topic, state, now, scheduler)
+        changes = dedup.changes(topic, command) if dedup is not None else command
+        if changes is None:
+            if log_info:
+                logging.info("Suppressed Light.Set on %s, already at %s", topic, state)
+            event_ns.pop(topic, None)
+            continue
+        request_id = tracker.begin(topic, state, now) if tracker is not None else next_request_id()
+        if dedup is not None:
+            dedup.sent(topic, request_id, command)
+        result = publish_state(client, topic, changes, request_id)
+        if metrics is not None and topic in event_ns:
+            since_ns = event_ns.pop(topic)
+            metrics.observe("publish", since_ns)
+            if result is not None:
+                metrics.track_publish(result.mid, since_ns)
+
+def worker_thread(router, client, scheduler):
+    """
+    Worker thread function that collects dirty routes and publishes their state.
+
+    Each state is handed to the PublishScheduler, which keeps only the newest state per
+    dimmer and releases it under the dimmer's rate cap, and recorded in the state store.
+    Released states pass through the FadeEngine on their way to the dimmer, and Light.Set
+    requests left unanswered are retried through the scheduler. While the broker is
+    unreachable nothing is released: the scheduler keeps only the newest state per
+    dimmer, and those are sent once on reconnect.
+    The thread sleeps until a route turns dirty, the next scheduled publish is due, the
+    state store needs flushing or the scheduler counters are due to be logged.
+    """
+    metrics = router.metrics
+    store = router.state_store
+    tracker = router.rpc_tracker
+    event_ns = {}  # Receive time of the newest knob event behind each queued publish
+    next_stats = time.monotonic() + SCHEDULER_STATS_INTERVAL
+    last_stats = None
+    was_online = False
     while True:
-        if parser._lock.acquire(timeout=LOCK_TIMEOUT):
+        online = router.online
+        if online and not was_online and len(scheduler):
+            logging.warning(f"Connected, sending the latest state of {len(scheduler)} dimmers held while offline")
+        was_online = online
+        deadline = earliest(scheduler.next_deadline() if online else None, next_stats,
+                            store.next_deadline() if store is not None else None,
+                            tracker.next_deadline() if tracker is not None and online else None)
+        timeout = max(0.0, deadline - time.monotonic())
+        for route in router.take_dirty(timeout):
             try:
-                while not parser.dirty:
-                    parser._lock.wait()  # Wait for the condition variable to be notified
-                state = parser.report_state()
-                logging.info(f"Worker thread reported state: {state}")
+                state = route.parser.report_state()
             except TimeoutError as e:
-                logging.error(f"Worker thread error: {e}")
-            finally:
-                parser._lock.release()
-            # Create the payload with the current parser.output value and brightness
-            on_value = parser.output
-            brightness_value = parser.brightness
-            payload = f'{{"id":124, "src":"timtw", "method":"Light.Set", "params":{{"id":0,"on":{str(on_value).lower()},"brightness":{brightness_value}}}}}'
-            # Publish the payload to the topic
-            logging.info(f"Publishing message: {topic} {payload}")
-            try:
-                result = client.publish(topic, payload)
-                # Check if the publish was successful
-                if result.rc != mqtt.MQTT_ERR_SUCCESS:
-                    logging.error(f"Failed to publish message: {result.rc}")
-            except Exception as e:
-                logging.error(f"An error occurred while publishing {topic} {payload}: {e}")
-
-parser = SmartKnobParser()
+                logging.error("Worker thread error: %s", e)
+                continue
+            if log_info:
+                logging.info("Worker thread reported state for %s: %s", route.knob, state)
+            targets = route.targets(state)
+            for topic, target in targets:
+                scheduler.submit(topic, target)
+            if store is not None:
+                store.update(route.knob, state["brightness"], state["output"])
+            if metrics is not None:
+                metrics.observe("worker_wakeup", route.event_ns)
+                for topic, _ in targets:
+                    event_ns[topic] = route.event_ns
+        now = time.monotonic()
+        if store is not None:
+            store.flush_due(now)
+        if online:
+            if tracker is not None:
+                retry_expired(tracker, scheduler, now)
+            release_due(router, client, scheduler, now, event_ns)
+        if now >= next_stats:
+            last_stats = report_scheduler_stats(scheduler, last_stats)
+            next_stats = now + SCHEDULER_STATS_INTERVAL
 
 def on_connect(client, userdata, flags, rc):
     """
     Callback for when the client receives a CONNACK response from the broker.
     
     :param client: The MQTT client instance.
-    :param userdata: The private user data as set in Client() or userdata_set().
+    :param userdata: The KnobRouter as set in Client().
     :param flags: Response flags sent by the broker.
     :param rc: The connection result.
     :return: None
     """
     if rc == 0:
         logging.info("Connected to MQTT Broker")
-        client.subscribe(MQTT_TOPIC)
+        client.subscribe([(topic, 0) for topic in userdata.subscriptions()])
+        userdata.request_device_status(client)
+        userdata.set_online(True)
     else:
         logging.error(f"Failed to connect, return code {rc}")
 
+def on_disconnect(client, userdata, rc):
+    """
+    Callback for when the client disconnects from the broker.
+
+    Publishing stops until on_connect; the newest state per dimmer waits in the scheduler.
+
+    :param client: The MQTT client instance.
+    :param userdata: The KnobRouter as set in Client().
+    :param rc: The disconnection result, 0 if disconnect() was called.
+    :return: None
+    """
+    userdata.set_online(False)
+    if rc != 0:
+        logging.error(f"Disconnected from MQTT Broker, return code {rc}")
+
 def on_message(client, userdata, msg):
     """
     Callback for when a PUBLISH message is received from the broker.
     
     :param client: The MQTT client instance.
-    :param userdata: The private user data as set in Client() or userdata_set().
+    :param userdata: The KnobRouter as set in Client().
     :param msg: An instance of MQTTMessage.
     :return: None
     """
-    global message_counter
-    payload = msg.payload.decode("utf-8")
-    logging.debug(f"Received message on topic: {msg.topic} with payload: {payload}")
-    parser.parse_message(msg.topic, payload)
-    message_counter += 1
-    if message_counter >= TRUNCATE_INTERVAL:
-        truncate_log_file()
-        message_counter = 0
-
-# Set up MQTT client
-client = mqtt.Client()
-client.on_connect = on_connect
-client.on_message = on_message
-
-# Connect to MQTT Broker
-client.connect(MQTT_BROKER, MQTT_PORT, 60)
-
-# Start the worker thread
-worker = threading.Thread(target=worker_thread, args=(parser,), daemon=True)
-worker.start()
-
-# Blocking loop to process network traffic and dispatch callbacks
-client.loop_forever()
\ No newline at end of file
+    received_ns = time.perf_counter_ns()
+    if log_debug:
+        logging.debug("Received message on topic: %s with payload: %s", msg.topic, msg.payload.decode("utf-8", "replace"))
+    userdata.dispatch(msg.topic, msg.payload, received_ns)
+
+def on_publish(client, userdata, mid):
+    """
+    Callback for when a PUBLISH has been handed to the network.
+
+    :param client: The MQTT client instance.
+    :param userdata: The KnobRouter as set in Client().
+    :param mid: The message id returned by publish().
+    :return: None
+    """
+    if userdata.metrics is not None:
+        userdata.metrics.publish_acked(mid)
+
+def setup_metrics(args, scheduler, rpc_tracker=None):
+    """Creates the Metrics object and starts its exporters if requested on the command line."""
+    if not args.metrics_port and not args.stats_interval:
+        return None
+    metrics = Metrics()
+    metrics.add_collector("scheduler", scheduler.stats)
+    if rpc_tracker is not None:
+        metrics.add_collector("rpc", rpc_tracker.stats)
+    if args.metrics_port:
+        start_http_server(metrics, args.metrics_port)
+    if args.stats_interval:
+        start_stats_dumper(metrics, args.stats_interval)
+    return metrics
+
+def open_state_store(args):
+    """Opens the state store named on the command line and flushes it at exit."""
+    if not args.state_file:
+        return None
+    store = StateStore(args.state_file)
+    atexit.register(store.flush)
+    return store
+
+def open_device_states(args):
+    """Creates the device state cache unless disabled on the command line."""
+    return None if args.no_device_sync else DeviceStateCache(RPC_SRC)
+
+def run_threaded(config, args, watcher=None, wildcard_topics=True):
+    """
+    Runs the controller with its worker thread until the process exits.
+
+    :param config: The config from load_config().
+    :param args: The parsed command line.
+    :param watcher: Optional ConfigWatcher, polled on the network thread.
+    :param wildcard_topics: As KnobRouter.wildcard_topics.
+    :return: Does not return.
+    """
+    host, port = config["mqtt"]["host"], config["mqtt"]["port"]
+    scheduler = PublishScheduler(args.max_rate)
+    tracker = RpcTracker()
+    router_class = KnobRouter
+    if args.compact_state:
+        from compact_state import ArrayKnobRouter as router_class
+    router = router_class(config["devices"], metrics=setup_metrics(args, scheduler, tracker),
+                          state_store=open_state_store(args), device_states=open_device_states(args),
+                          rpc_tracker=tracker)
+    router.wildcard_topics = wildcard_topics
+    router.configure_scheduler(scheduler)
+
+    # Set up MQTT client
+    client = mqtt.Client(userdata=router)
+    client.on_connect = on_connect
+    client.on_disconnect = on_disconnect
+    client.on_message = on_message
+    client.on_publish = on_publish
+
+    # Start the worker thread
+    worker = threading.Thread(target=worker_thread, args=(router, client, scheduler), daemon=True)
+    worker.start()
+
+    # Blocking loop to connect, process network traffic and dispatch callbacks; the
+    # config is reloaded on this same thread, between messages
+    on_tick = None
+    if watcher is not None:
+        on_tick = lambda: reload_config(watcher, router, client, scheduler)
+    run_network_loop(client, router, host, port, 60, on_tick)
+
+def main():
+    """Loads the device map, connects to the broker and runs the controller."""
+    arg_parser = argparse.ArgumentParser(description="Smart knob to Shelly dimmer controller")
+    arg_parser.add_argument("--map", default=DEVICE_MAP_PATH, help="Path to the knob -> dimmer mapping file")
+    arg_parser.add_argument("--max-rate", type=float, default=MAX_COMMANDS_PER_SECOND,
+                            help="Maximum Light.Set commands per second per dimmer")
+    arg_parser.add_argument("--asyncio", action="store_true",
+                            help="Run on a single asyncio event loop instead of the worker thread")
+    arg_parser.add_argument("--metrics-port", type=int, default=0,
+                            help="Serve Prometheus metrics on this local port (0 disables)")
+    arg_parser.add_argument("--stats-interval", type=float, default=0,
+                            help="Print a latency/counter summary every N seconds (0 disables)")
+    arg_parser.add_argument("--state-file", default=STATE_FILE_PATH,
+                            help="File the last state per knob is saved to and restored from ('' disables)")
+    arg_parser.add_argument("--no-device-sync", action="store_true",
+                            help="Do not follow the dimmers' own status (Light.GetStatus and NotifyStatus)")
+    arg_parser.add_argument("--compact-state", action="store_true",
+                            help="Keep the knob state in shared typed arrays, for thousands of knobs")
+    arg_parser.add_argument("--no-reload", action="store_true",
+                            help="Do not watch the mapping file for changes")
+    arg_parser.add_argument("--shards", type=int, default=1,
+                            help="Spread the knobs over this many worker processes, each with its own connection")
+    args = arg_parser.parse_args()
+    if args.compact_state and args.asyncio:
+        arg_parser.error("--compact-state is not supported with --asyncio")
+    if args.shards > 1 and args.asyncio:
+        arg_parser.error("--shards is not supported with --asyncio")
+
+    setup_logging()
+    # Exit through SystemExit on SIGTERM so atexit handlers (state flush, log listener) run
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    watcher = ConfigWatcher(args.map, load_config)
+    config = watcher.config
+    apply_brightness_limits(config["brightness"])
+    host, port = config["mqtt"]["host"], config["mqtt"]["port"]
+    if args.no_reload:
+        watcher = None
+    if args.asyncio:
+        import asyncio
+        import smart_knob_async
+        asyncio.run(smart_knob_async.run(config["devices"], args, host, port, watcher))
+        return
+
+    if args.shards > 1:
+        from sharding import run_supervisor
+        run_supervisor(config, args, watcher)
+        return
+    run_threaded(config, args, watcher)
+
+if __name__ == "__main__":
+    # Let smart_knob_async and compact_state import this module instead of loading a second
+    # copy, so they share its brightness limits and cached log levels
+    sys.modules.setdefault("smart_knob_mqtt", sys.modules[__name__])
+    main()
@@ -0,0 +1,411 @@
+"""
+Soak test: runs the controller against a local broker, simulated knobs and simulated dimmers.
+
+The controller runs unmodified as a subprocess, pointed at the broker through the
+"mqtt" setting of a generated map file. Simulated Smart_Knob devices publish gestures
+built from the payload shapes in messages.txt, and simulated Shelly dimmers answer
+Light.Set and Light.GetStatus over MQTT RPC and publish NotifyStatus events like the
+real devices. By default the broker is mini_broker.MiniBroker running in this process.
+
+Every report interval a line with throughput, knob-to-Light.Set latency, and the
+controller's memory and thread count is printed; the summary fits a trend to each so
+slow leaks and latency drift show up over multi-hour runs.
+
+    python soak_test.py --knobs 200 --duration 3h
+    python soak_test.py --knobs 2000 --idle-gap 10 --duration 30m --controller-args="--compact-state"
+    python soak_test.py --broker 127.0.0.1:1883 --knobs 50 --duration 8h --output soak.jsonl
+"""
+import argparse
+import heapq
+import json
+import os
+import random
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from analyze_logs import Trend
+from bench_replay import gesture_payloads
+from knob_metrics import LatencyHistogram
+from mini_broker import MiniBroker
+from smart_knob_mqtt import Z2M_BASE_TOPIC
+
+SOAK_REPORT_INTERVAL = 60  # Seconds between report lines
+MEAN_IDLE_GAP = 5.0  # Mean seconds between the gestures of one knob
+LATENCY_WINDOW = 5.0  # Seconds after a knob event within which a Light.Set is counted as its response
+STARTUP_TIMEOUT = 15  # Seconds to wait for the controller to request the status of every dimmer
+CONTROLLER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "smart_knob_mqtt.py")
+
+def parse_duration(text):
+    """Parses a duration such as 90, 90s, 30m or 3h into seconds."""
+    units = {"s": 1, "m": 60, "h": 3600}
+    if text and text[-1] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+def knob_events(knobs, idle_gap, rng):
+    """
+    Generates an endless event stream for a fleet of knobs.
+
+    Each knob alternates exponentially distributed idle gaps and gestures from
+    gesture_payloads(); gestures of different knobs interleave.
+
+    :param knobs: List of knob names.
+    :param idle_gap: Mean seconds between the gestures of one knob.
+    :param rng: The random.Random to draw from.
+    :return: Iterator of (seconds, knob index, payload bytes, first message of its gesture)
+             in time order.
+    """
+    starts = [(rng.uniform(0, idle_gap), index) for index in range(len(knobs))]
+    heapq.heapify(starts)
+    pending = []  # (seconds, sequence, knob index, payload, first) of generated gesture messages
+    sequence = 0
+    while True:
+        start, index = heapq.heappop(starts)
+        while pending and pending[0][0] <= start:
+            t, _, knob, payload, first = heapq.heappop(pending)
+            yield t, knob, payload, first
+        t = start
+        for position, payload in enumerate(gesture_payloads(rng)):
+            heapq.heappush(pending, (t, sequence, index, payload, position == 0))
+            sequence += 1
+            t += rng.uniform(0.05, 0.2)
+        heapq.heappush(starts, (t + rng.expovariate(1 / idle_gap), index))
+
+class SoakStats:
+    """
+    Counters and knob-to-Light.Set latency for one report interval.
+
+    The latency of a gesture runs from its first knob event to the first Light.Set
+    that reaches the knob's dimmer. Gestures that change nothing, e.g. stepping up at
+    full brightness, get no command; they are replaced by the next gesture or dropped
+    after LATENCY_WINDOW seconds instead of being matched with an unrelated command.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}  # dimmer -> time of the first knob event not yet followed by a command
+        self.latency = LatencyHistogram()
+        self.events = 0
+        self.commands = 0
+        self.status_requests = 0
+
+    def knob_event(self, dimmer, now, gesture_start):
+        """Records a knob event sent for a dimmer; gesture_start marks the first event of a gesture."""
+        with self._lock:
+            self.events += 1
+            if gesture_start:
+                self._pending[dimmer] = now
+
+    def command(self, dimmer, now):
+        """Records a Light.Set received by a dimmer."""
+        with self._lock:
+            self.commands += 1
+            first = self._pending.pop(dimmer, None)
+            if first is not None and now - first <= LATENCY_WINDOW:
+                self.latency.record(int((now - first) * 1e9))
+
+    def status_request(self):
+        with self._lock:
+            self.status_requests += 1
+
+    def take(self):
+        """Returns the interval's counters and latency histogram and starts a new interval."""
+        with self._lock:
+            taken = {"events": self.events, "commands": self.commands, "latency": self.latency}
+            self.events = self.commands = 0
+            self.latency = LatencyHistogram()
+        return taken
+
+class ShellyFleet:
+    """
+    Simulated Shelly dimmers on one MQTT connection.
+
+    Each dimmer answers Light.Set and Light.GetStatus requests on <dimmer>/rpc with a
+    response on <src>/rpc, and publishes a NotifyStatus event on <dimmer>/events/rpc
+    whenever a Light.Set changes its state. Other methods get a 404 error response.
+    """
+
+    def __init__(self, dimmers, stats, start_brightness=50):
+        """
+        Initializes the ShellyFleet.
+
+        :param dimmers: List of Shelly device ids.
+        :param stats: The SoakStats receiving every Light.Set.
+        :param start_brightness: Brightness every dimmer starts at, switched on.
+        """
+        self.dimmers = dimmers
+        self.stats = stats
+        self.states = {dimmer: {"output": True, "brightness": start_brightness} for dimmer in dimmers}
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id="soak-shelly-fleet")
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+
+    def on_connect(self, client, userdata, flags, rc):
+        client.subscribe([(f"{dimmer}/rpc", 0) for dimmer in self.dimmers])
+
+    def on_message(self, client, userdata, message):
+        dimmer = message.topic[:-len("/rpc")]
+        state = self.states.get(dimmer)
+        try:
+            request = json.loads(message.payload)
+            request_id, src, method = request["id"], request["src"], request["method"]
+        except (ValueError, KeyError, TypeError):
+            return
+        reply = {"id": request_id, "src": dimmer, "dst": src}
+        if state is None:
+            return
+        if method == "Light.Set":
+            self.stats.command(dimmer, time.monotonic())
+            params = request.get("params", {})
+            changes = {}
+            if "on" in params and params["on"] != state["output"]:
+                changes["output"] = params["on"]
+            if "brightness" in params and params["brightness"] != state["brightness"]:
+                changes["brightness"] = params["brightness"]
+            reply["result"] = None
+            client.publish(f"{src}/rpc", json.dumps(reply))
+            if changes:
+                state.update(changes)
+                event = {"src": dimmer, "dst": f"{dimmer}/events", "method": "NotifyStatus",
+                         "params": {"ts": time.time(), "light:0": dict(changes, id=0)}}
+                client.publish(f"{dimmer}/events/rpc", json.dumps(event))
+        elif method == "Light.GetStatus":
+            self.stats.status_request()
+            reply["result"] = dict(state, id=0, source="init")
+            client.publish(f"{src}/rpc", json.dumps(reply))
+        else:
+            reply["error"] = {"code": 404, "message": f"No handler for {method}"}
+            client.publish(f"{src}/rpc", json.dumps(reply))
+
+def child_pids(pid):
+    """Returns the ids of all descendants of a process, from /proc."""
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", 'r') as file:
+                parents[int(entry)] = int(file.read().rpartition(')')[2].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+    descendants = []
+    queue = [pid]
+    while queue:
+        parent = queue.pop()
+        children = [child for child, child_parent in parents.items() if child_parent == parent]
+        descendants += children
+        queue += children
+    return descendants
+
+def process_status(pid):
+    """
+    Reads the resident memory and thread count of a process and its children, e.g. the
+    shards of a sharded controller, from /proc.
+
+    :return: (RSS in MB, threads), or (None, None) where /proc is not available.
+    """
+    rss_kb = threads = 0
+    try:
+        pids = [pid] + child_pids(pid)
+    except OSError:
+        return None, None
+    for process in pids:
+        try:
+            with open(f"/proc/{process}/status", 'r') as file:
+                fields = dict(line.split(':', 1) for line in file if ':' in line)
+        except OSError:
+            if process == pid:
+                return None, None
+            continue  # Exited meanwhile
+        rss_kb += int(fields["VmRSS"].split()[0])
+        threads += int(fields["Threads"])
+    return rss_kb / 1024, threads
+
+def start_controller(workdir, host, port, devices, extra_args):
+    """
+    Writes a map file for the simulated fleet and starts the controller on it.
+
+    :param workdir: Directory for the map, state and log files of the controller.
+    :param host: Broker address.
+    :param port: Broker port.
+    :param devices: The knob -> dimmer mapping table.
+    :param extra_args: Further controller command line arguments.
+    :return: The controller's subprocess.Popen.
+    """
+    map_path = os.path.join(workdir, "soak_map.json")
+    with open(map_path, 'w') as file:
+        json.dump({"devices": devices, "mqtt": {"host": host, "port": port}}, file)
+    command = [sys.executable, CONTROLLER_SCRIPT, "--map", map_path,
+               "--state-file", os.path.join(workdir, "soak_state.jsonl")] + extra_args
+    return subprocess.Popen(command, cwd=workdir)
+
+def stop_controller(controller):
+    """Stops the controller with SIGTERM, so it flushes its state, and kills it if it hangs."""
+    controller.terminate()
+    try:
+        controller.wait(10)
+    except subprocess.TimeoutExpired:
+        controller.kill()
+        controller.wait()
+
+def format_trend(name, trend, unit):
+    if trend.n == 0:
+        return f"{name}: n/a"
+    slope = trend.slope_per_hour()
+    slope_text = f"  trend {slope:+.2f}{unit}/h" if slope is not None else ""
+    return (f"{name}: first {trend.first:.1f}{unit}  last {trend.last:.1f}{unit}  "
+            f"min {trend.min:.1f}{unit}  max {trend.max:.1f}{unit}{slope_text}")
+
+class SoakReporter:
+    """Prints one line per report interval and keeps the trends for the summary."""
+
+    def __init__(self, stats, controller, broker=None, output=None):
+        """
+        Initializes the SoakReporter.
+
+        :param stats: The SoakStats to take the interval counters from.
+        :param controller: The controller's subprocess.Popen, for memory and threads.
+        :param broker: The in-process MiniBroker, or None.
+        :param output: Optional open file receiving each report as a JSON line.
+        """
+        self.stats = stats
+        self.controller = controller
+        self.broker = broker
+        self.output = output
+        self.trends = {"rss_mb": Trend(), "threads": Trend(), "p50_ms": Trend(), "p99_ms": Trend(),
+                       "commands_s": Trend()}
+        self.events = 0
+        self.commands = 0
+        self.start = self._last = time.monotonic()
+
+    def report(self, now):
+        """Reports the interval ending now and returns the report dict."""
+        interval = self.stats.take()
+        elapsed = now - self.start
+        seconds = max(now - self._last, 1e-9)
+        self._last = now
+        latency = interval["latency"]
+        rss_mb, threads = process_status(self.controller.pid)
+        report = {"elapsed": round(elapsed), "events_s": round(interval["events"] / seconds, 1),
+                  "commands_s": round(interval["commands"] / seconds, 1),
+                  "p50_ms": round(latency.percentile(0.5) / 1e6, 2), "p99_ms": round(latency.percentile(0.99) / 1e6, 2),
+                  "max_ms": round(latency.max / 1e6, 2),
+                  "rss_mb": round(rss_mb, 1) if rss_mb is not None else None, "threads": threads}
+        if self.broker is not None:
+            report["broker_in"], report["broker_out"] = self.broker.messages_in, self.broker.messages_out
+        print(f"{elapsed:7.0f}s  events/s {report['events_s']:8.1f}  Light.Set/s {report['commands_s']:7.1f}  "
+              f"latency p50 {report['p50_ms']}ms p99 {report['p99_ms']}ms max {report['max_ms']}ms  "
+              f"rss {report['rss_mb']}MB  threads {threads}", flush=True)
+        if self.output is not None:
+            self.output.write(json.dumps(report) + "\n")
+            self.output.flush()
+        if latency.count == 0:
+            report["p50_ms"] = report["p99_ms"] = None  # No gesture completed; not a latency reading
+        for name, trend in self.trends.items():
+            if report[name] is not None:
+                trend.add(report[name], elapsed)
+        self.events += interval["events"]
+        self.commands += interval["commands"]
+        return report
+
+    def summary(self, knobs):
+        elapsed = self._last - self.start
+        print(f"\n{elapsed:.0f}s, {knobs} knobs: {self.events} knob events, "
+              f"{self.commands} Light.Set ({self.commands / max(elapsed, 1e-9):.1f}/s)")
+        print(format_trend("memory", self.trends["rss_mb"], "MB"))
+        print(format_trend("threads", self.trends["threads"], ""))
+        print(format_trend("latency p50", self.trends["p50_ms"], "ms"))
+        print(format_trend("latency p99", self.trends["p99_ms"], "ms"))
+        print(format_trend("Light.Set rate", self.trends["commands_s"], "/s"))
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Soak test the controller against simulated knobs and dimmers")
+    arg_parser.add_argument("--knobs", type=int, default=100, help="Number of simulated knobs, one dimmer each")
+    arg_parser.add_argument("--idle-gap", type=float, default=MEAN_IDLE_GAP,
+                            help="Mean seconds between the gestures of one knob")
+    arg_parser.add_argument("--duration", type=parse_duration, default=3600,
+                            help="Run time, in seconds or with an s/m/h suffix")
+    arg_parser.add_argument("--report-interval", type=float, default=SOAK_REPORT_INTERVAL,
+                            help="Seconds between report lines")
+    arg_parser.add_argument("--broker", default=None,
+                            help="host:port of an existing broker instead of the in-process one")
+    arg_parser.add_argument("--controller-args", default="", help="Extra controller arguments, e.g. --controller-args=\"--asyncio\"")
+    arg_parser.add_argument("--output", default=None, help="Also write every report as a JSON line to this file")
+    arg_parser.add_argument("--seed", type=int, default=1, help="Random seed of the knob traffic")
+    args = arg_parser.parse_args()
+
+    broker = None
+    if args.broker:
+        host, _, port = args.broker.rpartition(':')
+        port = int(port)
+    else:
+        broker = MiniBroker()
+        host, port = broker.host, broker.start_in_thread()
+
+    knobs = [f"Soak_Knob_{i}" for i in range(args.knobs)]
+    dimmers = [f"soak_dimmer_{i}" for i in range(args.knobs)]
+    knob_topics = [f"{Z2M_BASE_TOPIC}/{knob}" for knob in knobs]
+    stats = SoakStats()
+
+    fleet = ShellyFleet(dimmers, stats)
+    fleet.client.connect(host, port)
+    fleet.client.loop_start()
+    knob_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id="soak-knob-fleet")
+    knob_client.connect(host, port)
+    knob_client.loop_start()
+
+    workdir = tempfile.mkdtemp(prefix="soak_")
+    controller = start_controller(workdir, host, port, [{"knob": knob, "dimmer": dimmer}
+                                                        for knob, dimmer in zip(knobs, dimmers)],
+                                  shlex.split(args.controller_args))
+    print(f"Controller pid {controller.pid}, broker {host}:{port}, files in {workdir}")
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while stats.status_requests < args.knobs and time.monotonic() < deadline and controller.poll() is None:
+        time.sleep(0.1)
+    if stats.status_requests < args.knobs:
+        print(f"Controller requested the status of {stats.status_requests}/{args.knobs} dimmers, starting anyway")
+
+    output = open(args.output, 'w') if args.output else None
+    reporter = SoakReporter(stats, controller, broker, output)
+    start = reporter.start
+    next_report = start + args.report_interval
+    finished = False
+    try:
+        for t, index, payload, gesture_start in knob_events(knobs, args.idle_gap, random.Random(args.seed)):
+            while True:
+                now = time.monotonic()
+                if now >= next_report:
+                    reporter.report(now)
+                    next_report += args.report_interval
+                    if now - start >= args.duration:
+                        finished = True
+                        break
+                if controller.poll() is not None:
+                    print(f"Controller exited with code {controller.returncode}")
+                    finished = True
+                    break
+                if start + t <= now:
+                    break
+                time.sleep(min(start + t, next_report) - now)
+            if finished:
+                break
+            knob_client.publish(knob_topics[index], payload)
+            stats.knob_event(dimmers[index], now, gesture_start)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_controller(controller)
+        knob_client.loop_stop()
+        fleet.client.loop_stop()
+        if output is not None:
+            output.close()
+    reporter.summary(args.knobs)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import json
+import logging
+import os
+import threading
+import time
+
+STATE_FLUSH_INTERVAL = 2.0  # Seconds an update may wait before it is written out
+COMPACT_FACTOR = 4  # Rewrite the file once it holds this many records per device
+COMPACT_MIN_RECORDS = 256
+
+class StateStore:
+    """
+    Crash-safe store of the last brightness/output of each knob.
+
+    The file is append-only JSON lines, {"k": key, "b": brightness, "o": output}, and the
+    last record of a key wins. Updates are held in memory and appended in one write plus
+    fsync at most every flush_interval seconds. A torn final line from a crash is cut
+    off on load, so the next append starts on a fresh line. Whenever the file grows past
+    COMPACT_FACTOR records per key it is rewritten through a temporary file and an
+    atomic rename.
+
+    Like PublishScheduler, the store runs no thread of its own: the owner calls
+    flush_due() once next_deadline() has passed.
+    """
+
+    def __init__(self, path, flush_interval=STATE_FLUSH_INTERVAL, clock=time.monotonic):
+        """
+        Initializes the StateStore and loads the saved state.
+
+        :param path: Path of the state file.
+        :param flush_interval: Maximum seconds between an update and its write.
+        :param clock: Monotonic clock returning seconds.
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = {}
+        self._pending = {}
+        self._flush_at = None
+        self._records = 0
+        self._load()
+
+    def _load(self):
+        started = time.perf_counter()
+        complete = 0  # Byte offset just past the last complete line
+        torn = False
+        try:
+            with open(self.path, 'rb') as file:
+                for line in file:
+                    if not line.endswith(b'\n'):
+                        torn = True
+                        break
+                    complete += len(line)
+                    try:
+                        record = json.loads(line)
+                        self._state[record["k"]] = (record["b"], record["o"])
+                    except (ValueError, KeyError, TypeError):
+                        logging.warning(f"Skipping damaged record in {self.path}")
+                        continue
+                    self._records += 1
+        except FileNotFoundError:
+            return
+        if torn:
+            logging.warning(f"Truncating torn final record in {self.path}")
+            try:
+                with open(self.path, 'r+b') as file:
+                    file.truncate(complete)
+            except OSError as e:
+                logging.error(f"Failed to truncate state file {self.path}: {e}")
+                self._compact()
+        logging.info(f"Loaded state of {len(self._state)} devices from {self.path} "
+                     f"in {(time.perf_counter() - started) * 1000:.1f} ms")
+        self._compact_if_needed()
+
+    def _compact_if_needed(self):
+        """Compacts the file once it holds more than COMPACT_FACTOR records per key."""
+        if self._records > max(COMPACT_MIN_RECORDS, COMPACT_FACTOR * len(self._state)):
+            self._compact()
+
+    def get(self, key):
+        """Returns the saved (brightness, output) of a key, or None."""
+        return self._state.get(key)
+
+    def update(self, key, brightness, output, now=None):
+        """
+        Records a new state; it is written out by the next flush.
+
+        :param key: The device key (the knob name).
+        :param brightness: The brightness value.
+        :param output: The output state.
+        :param now: Current time in seconds, defaults to the store clock.
+        :return: None
+        """
+        value = (brightness, output)
+        with self._lock:
+            if self._state.get(key) == value and key not in self._pending:
+                return
+            self._state[key] = value
+            self._pending[key] = value
+            if self._flush_at is None:
+                self._flush_at = (self._clock() if now is None else now) + self.flush_interval
+
+    def next_deadline(self):
+        """Returns the time the pending updates must be flushed, or None if there are none."""
+        return self._flush_at
+
+    def flush_due(self, now=None):
+        """Flushes the pending updates if their deadline has passed."""
+        if self._flush_at is not None and (self._clock() if now is None else now) >= self._flush_at:
+            self.flush()
+
+    def flush(self):
+        """Appends all pending updates to the file in one write and fsyncs it."""
+        with self._lock:
+            if not self._pending:
+                return
+            lines = [json.dumps({"k": key, "b": brightness, "o": output}, separators=(',', ':')) + "\n"
+                     for key, (brightness, output) in self._pending.items()]
+            self._pending.clear()
+            self._flush_at = None
+            try:
+                with open(self.path, 'a') as file:
+                    file.write("".join(lines))
+                    file.flush()
+                    os.fsync(file.fileno())
+            except OSError as e:
+                logging.error(f"Failed to write state file {self.path}: {e}")
+                return
+            self._records += len(lines)
+            self._compact_if_needed()
+
+    def _compact(self):
+        """Rewrites the file with one record per key."""
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, 'w') as file:
+                for key, (brightness, output) in self._state.items():
+                    file.write(json.dumps({"k": key, "b": brightness, "o": output}, separators=(',', ':')) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.error(f"Failed to compact state file {self.path}: {e}")
+            return
+        self._records = len(self._state)